@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import pathlib
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+from fake_origin import FakeOrigin
+
+# end to end runs of hls-localise.py and decrypt_fragments.py against a local
+# fake origin, each run is a child process sampled through /proc for its rss
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+SAMPLE_INTERVAL = 0.05
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def read_status(pid, field):
+    # kilobytes, 0 once the process is gone
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def get_children(pid):
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    for child in list(children):
+        children.extend(get_children(child))
+    return children
+
+
+def run(command, cwd):
+    # ru_maxrss of a forked child starts at the size of this process, so the
+    # peak is sampled instead: VmHWM of the child, or the summed rss of its
+    # process tree when it runs workers of its own
+    started = time.monotonic()
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen([sys.executable] + command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr)
+        peak = 0
+        while process.poll() is None:
+            tree = sum(read_status(child, 'VmRSS:') for child in get_children(process.pid))
+            peak = max(peak, read_status(process.pid, 'VmHWM:'), read_status(process.pid, 'VmRSS:') + tree)
+            time.sleep(SAMPLE_INTERVAL)
+        elapsed = time.monotonic() - started
+        if process.returncode:
+            stderr.seek(0)
+            logging.error(f'{command[0]} exited with {process.returncode}\n'
+                          f'{stderr.read().decode(errors="replace")[-2000:]}')
+    return elapsed, peak / 1024
+
+
+def get_size(directory, suffix):
+    return sum(path.stat().st_size for path in pathlib.Path(directory).rglob(f'*{suffix}') if path.is_file())
+
+
+def read_lags(metrics_path):
+    lags = []
+    if not os.path.exists(metrics_path):
+        return lags
+    with open(metrics_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == 'lag':
+                lags.append(record['lag'])
+    return lags
+
+
+def report(name, elapsed, size, rss, lags=None):
+    throughput = size * 8 / elapsed / 1000 / 1000 if elapsed else 0
+    line = f'{name:<32} {elapsed:8.2f} s {size / 1024 / 1024:9.1f} MiB {throughput:9.1f} Mbit/s {rss:8.1f} MiB rss'
+    if lags:
+        line += f'  lag p50 {percentile(lags, 0.5):.2f} s max {max(lags):.2f} s'
+    print(line)
+
+
+def bench_vod(args, workdir, mode):
+    origin = FakeOrigin(args.levels, args.segment_duration, args.segment_size, segments=args.segments, live=False,
+                        latency=args.latency, bandwidth=args.bandwidth).start()
+    directory = os.path.join(workdir, f'vod-{mode}')
+    command = [str(ROOT.joinpath('hls-localise.py')), '-m', origin.url, '--directory', directory, '--levels', 'all',
+               '-t', '3600', '--workers', str(args.workers)]
+    if mode != 'sequential':
+        command.append(f'--{mode}')
+    if args.decrypt:
+        command.append('--decrypt')
+    elapsed, rss = run(command, workdir)
+    origin.stop()
+    report(f'vod localise, {mode}', elapsed, get_size(directory, '.ts'), rss)
+    return directory
+
+
+def bench_live(args, workdir):
+    origin = FakeOrigin(args.levels, args.segment_duration, args.segment_size, window=args.window,
+                        latency=args.latency, bandwidth=args.bandwidth).start()
+    directory = os.path.join(workdir, 'live')
+    metrics_path = os.path.join(workdir, 'live-metrics.jsonl')
+    command = [str(ROOT.joinpath('hls-localise.py')), '-m', origin.url, '--directory', directory, '--levels', 'all',
+               '--asyncio', '-t', str(args.live_duration), '--workers', str(args.workers), '--metrics', metrics_path]
+    if args.decrypt:
+        command.append('--decrypt')
+    elapsed, rss = run(command, workdir)
+    origin.stop()
+    report('live localise, asyncio', elapsed, get_size(directory, '.ts'), rss, read_lags(metrics_path))
+
+
+def bench_decrypt(args, workdir, directory):
+    manifests = sorted(pathlib.Path(directory).glob('localised-level-*.m3u8'))
+    if not manifests:
+        logging.error(f'no localised level manifest in {directory}')
+        return
+    for jobs in args.jobs:
+        output = os.path.join(workdir, f'decrypted-{jobs}')
+        elapsed, rss = run([str(ROOT.joinpath('decrypt_fragments.py')), str(manifests[-1]), '-o', output,
+                            '-j', str(jobs)], workdir)
+        report(f'decrypt_fragments, {jobs} jobs', elapsed, get_size(output, '.ts'), rss)
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='bench-localise-')
+    try:
+        vod_directory = None
+        for mode in args.modes:
+            vod_directory = bench_vod(args, workdir, mode)
+        if args.live_duration:
+            bench_live(args, workdir)
+        if vod_directory and not args.decrypt:
+            bench_decrypt(args, workdir, vod_directory)
+    finally:
+        if args.keep:
+            print(f'kept {workdir}')
+        else:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = ArgumentParser()
+    parser.description = 'Benchmark hls-localise.py and decrypt_fragments.py against a local fake origin'
+    parser.add_argument('--levels',
+                        help='levels in the master playlist',
+                        default=3,
+                        type=int)
+    parser.add_argument('--segments',
+                        help='segments per level for the vod runs',
+                        default=60,
+                        type=int)
+    parser.add_argument('--segment-size',
+                        help='bytes per segment before encryption',
+                        default=512 * 1024,
+                        type=int)
+    parser.add_argument('--segment-duration',
+                        help='seconds per segment',
+                        default=1.0,
+                        type=float)
+    parser.add_argument('--window',
+                        help='segments in the live sliding window',
+                        default=6,
+                        type=int)
+    parser.add_argument('--latency',
+                        help='seconds the origin waits before every response',
+                        default=0.02,
+                        type=float)
+    parser.add_argument('--bandwidth',
+                        help='per connection bandwidth in Mbit/s, 0 is unlimited',
+                        default=0.0,
+                        type=float)
+    parser.add_argument('--modes',
+                        help='download modes for the vod runs',
+                        choices=['sequential', 'multithreading', 'asyncio'],
+                        default=['multithreading', 'asyncio'],
+                        nargs='+')
+    parser.add_argument('--workers',
+                        help='download scheduler workers',
+                        default=8,
+                        type=int)
+    parser.add_argument('--decrypt',
+                        help='decrypt while downloading, skips the decrypt_fragments.py runs',
+                        action='store_true')
+    parser.add_argument('--jobs',
+                        help='decrypt_fragments.py process counts to run',
+                        default=[1, os.cpu_count()],
+                        type=int,
+                        nargs='+')
+    parser.add_argument('--live-duration',
+                        help='seconds to capture the live levels, 0 skips the live run',
+                        default=10,
+                        type=int)
+    parser.add_argument('--keep',
+                        help='keep the downloaded files',
+                        action='store_true')
+    args = parser.parse_args()
+    args.bandwidth = int(args.bandwidth * 1000 * 1000 / 8)
+    main(args)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hls_parser
+
+
+def make_media_playlist(segments, key_every=100):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6', '#EXT-X-MEDIA-SEQUENCE:1000']
+    for sequence in range(1000, 1000 + segments):
+        if sequence % key_every == 0:
+            lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="https://cdn.example.com/keys/K{sequence}.key",'
+                         f'IV=0x{sequence:032x},KEYFORMATVERSIONS="1"')
+        if sequence % 500 == 0:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append(f'#EXT-X-PROGRAM-DATE-TIME:2023-11-07T00:{sequence // 10 % 60:02}:{sequence % 10 * 6:02}.000Z')
+        lines.append('#EXTINF:6.000,')
+        lines.append(f'https://cdn.example.com/live/channel/1080p/segment-{sequence}.ts')
+    return '\n'.join(lines) + '\n'
+
+
+def make_master_playlist(variants):
+    lines = ['#EXTM3U']
+    for variant in range(variants):
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={(variant + 1) * 250000},CODECS="avc1.640028,mp4a.40.5",'
+                     f'RESOLUTION={(variant + 1) * 64}x{(variant + 1) * 36},HDCP-LEVEL=NONE,SUBTITLES="subs1"')
+        lines.append(f'https://cdn.example.com/live/channel/level-{variant}.m3u8')
+    return '\n'.join(lines) + '\n'
+
+
+def bench(name, statement, number, items):
+    elapsed = min(timeit.repeat(statement, number=number, repeat=3)) / number
+    print(f'{name:<40} {elapsed * 1000:10.3f} ms {items / elapsed:14,.0f} items/s')
+
+
+def main(args):
+    for segments in args.segments:
+        contents = make_media_playlist(segments)
+        url = 'https://cdn.example.com/live/channel/1080p.m3u8'
+        last = 1000 + segments - 1 - args.new
+        number = max(1, 200000 // segments)
+        bench(f'media playlist {segments} segments', lambda: hls_parser.MediaPlaylist(contents, url), number, segments)
+        bench(f'  incremental, {args.new} new segments', lambda: hls_parser.MediaPlaylist(contents, url, after=last),
+              number, segments)
+
+    contents = make_master_playlist(args.variants)
+    bench(f'master playlist {args.variants} variants', lambda: hls_parser.MasterPlaylist(contents), 2000,
+          args.variants)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.description = 'Benchmark hls_parser over large synthetic playlists'
+    parser.add_argument('--segments',
+                        help='number of segments in each synthetic media playlist',
+                        default=[100, 1000, 10000, 100000],
+                        type=int,
+                        nargs='+')
+    parser.add_argument('--new',
+                        help='segments past the last ingested sequence for the incremental case',
+                        default=3,
+                        type=int)
+    parser.add_argument('--variants',
+                        help='number of variants in the synthetic master playlist',
+                        default=16,
+                        type=int)
+    main(parser.parse_args())
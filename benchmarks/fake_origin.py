@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import datetime
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Crypto.Cipher import AES
+
+# local stand in for a CDN: a master playlist, level playlists with a live
+# sliding window or a complete vod list, and AES-128 encrypted segments,
+# served with a configurable delay and per connection bandwidth
+
+KEY = bytes(range(16))
+
+
+def pad(data):
+    padding = AES.block_size - len(data) % AES.block_size
+    return data + bytes([padding]) * padding
+
+
+class FakeOrigin:
+    def __init__(self, levels=3, segment_duration=2.0, segment_size=256 * 1024, window=6, segments=30, live=True,
+                 encrypt=True, latency=0.0, bandwidth=0, port=0):
+        self.levels = levels
+        self.segment_duration = segment_duration
+        self.segment_size = segment_size
+        self.window = window
+        self.segments = segments
+        self.live = live
+        self.encrypt = encrypt
+        self.latency = latency
+        # bytes per second per connection, 0 is unlimited
+        self.bandwidth = bandwidth
+        self.port = port
+        self.server = None
+        self.started = None
+        self.lock = threading.Lock()
+        self.bodies = {}
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/master.m3u8'
+
+    def start(self):
+        origin = self
+
+        class OriginHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                origin.handle(self)
+
+            def log_message(self, format, *args):
+                logging.debug(f'origin - {format % args}')
+
+        # the live window starts a full window in the past so the first load
+        # already has `window` segments
+        self.started = time.time() - self.window * self.segment_duration
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), OriginHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='origin', daemon=True).start()
+        logging.info(f'origin on {self.url}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        path = request.path.split('?')[0]
+        body = None
+        content_type = 'application/vnd.apple.mpegurl'
+        if path == '/master.m3u8':
+            body = self.get_master().encode()
+        elif path == '/key.bin':
+            body = KEY
+            content_type = 'application/octet-stream'
+        else:
+            parts = path.strip('/').split('/')
+            if len(parts) == 2 and parts[0].startswith('level') and parts[0][5:].isdigit():
+                level = int(parts[0][5:])
+                if parts[1] == 'index.m3u8':
+                    body = self.get_level(level).encode()
+                elif parts[1].startswith('segment-') and parts[1].endswith('.ts'):
+                    body = self.get_segment(level, int(parts[1][8:-3]))
+                    content_type = 'video/mp2t'
+        if body is None:
+            request.send_error(404)
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        self.send(request, body)
+
+    def send(self, request, body):
+        if not self.bandwidth:
+            request.wfile.write(body)
+            return
+        chunk_size = 16 * 1024
+        started = time.monotonic()
+        for offset in range(0, len(body), chunk_size):
+            request.wfile.write(body[offset:offset + chunk_size])
+            delay = started + (offset + chunk_size) / self.bandwidth - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def get_master(self):
+        lines = ['#EXTM3U']
+        for level in range(self.levels):
+            bandwidth = (level + 1) * 800000
+            height = (level + 1) * 360
+            lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},CODECS="avc1.640028,mp4a.40.2",'
+                         f'RESOLUTION={height * 16 // 9}x{height}')
+            lines.append(f'level{level}/index.m3u8')
+        return '\n'.join(lines) + '\n'
+
+    def get_window(self):
+        if not self.live:
+            return 0, self.segments, True
+        last = int((time.time() - self.started) / self.segment_duration)
+        first = max(0, last - self.window)
+        return first, last, False
+
+    def get_level(self, level):
+        first, last, endlist = self.get_window()
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{int(self.segment_duration + 0.999)}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        if endlist:
+            lines.append('#EXT-X-PLAYLIST-TYPE:VOD')
+        if self.encrypt:
+            # no IV attribute, the media sequence number is the IV
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="../key.bin"')
+        for sequence in range(first, last):
+            program_date_time = datetime.datetime.fromtimestamp(self.started + sequence * self.segment_duration,
+                                                                datetime.timezone.utc)
+            lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{program_date_time.isoformat(timespec="milliseconds")}')
+            lines.append(f'#EXTINF:{self.segment_duration:.3f},')
+            lines.append(f'segment-{sequence}.ts')
+        if endlist:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def get_segment(self, level, sequence):
+        first, last, _ = self.get_window()
+        if not first <= sequence < last:
+            return None
+        with self.lock:
+            body = self.bodies.get((level, sequence))
+        if body is not None:
+            return body
+        body = self.get_cleartext(level, sequence)
+        if self.encrypt:
+            body = AES.new(KEY, AES.MODE_CBC, iv=sequence.to_bytes(16, 'big')).encrypt(pad(body))
+        with self.lock:
+            # only the live window is worth keeping around
+            self.bodies = {k: v for k, v in self.bodies.items() if k[1] >= first}
+            self.bodies[(level, sequence)] = body
+        return body
+
+    def get_cleartext(self, level, sequence):
+        pattern = f'level {level} segment {sequence} '.encode()
+        return (pattern * (self.segment_size // len(pattern) + 1))[:self.segment_size]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = ArgumentParser()
+    parser.description = 'Serve synthetic encrypted hls levels on localhost'
+    parser.add_argument('--port',
+                        help='port to listen on',
+                        default=8900,
+                        type=int)
+    parser.add_argument('--levels',
+                        help='number of levels in the master playlist',
+                        default=3,
+                        type=int)
+    parser.add_argument('--segment-duration',
+                        help='seconds per segment',
+                        default=2.0,
+                        type=float)
+    parser.add_argument('--segment-size',
+                        help='bytes per segment before encryption',
+                        default=256 * 1024,
+                        type=int)
+    parser.add_argument('--window',
+                        help='segments in the live sliding window',
+                        default=6,
+                        type=int)
+    parser.add_argument('--vod',
+                        help='serve complete playlists of --segments segments with EXT-X-ENDLIST',
+                        action='store_true')
+    parser.add_argument('--segments',
+                        help='segments per level in vod mode',
+                        default=30,
+                        type=int)
+    parser.add_argument('--clear',
+                        help='serve unencrypted segments',
+                        action='store_true')
+    parser.add_argument('--latency',
+                        help='seconds before every response',
+                        default=0.0,
+                        type=float)
+    parser.add_argument('--bandwidth',
+                        help='per connection bandwidth in Mbit/s, 0 is unlimited',
+                        default=0.0,
+                        type=float)
+    args = parser.parse_args()
+    origin = FakeOrigin(args.levels, args.segment_duration, args.segment_size, args.window, args.segments,
+                        not args.vod, not args.clear, args.latency, int(args.bandwidth * 1000 * 1000 / 8), args.port)
+    origin.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        origin.stop()
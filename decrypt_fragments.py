@@ -1,67 +1,89 @@
 #!/usr/bin/env python3
 
-import sys
+import os
+import shutil
 import pathlib
-from Crypto.Cipher import AES
-import ffmpegio
+import logging
+import concurrent.futures
+from argparse import ArgumentParser
 from util import Util
+from hls_parser import MediaPlaylist
+import hls_crypto
 
-output = '.output'
-output = pathlib.Path(output)
-Util.delete_directory(output)
-Util.make_directory(output)
 
-manifest_path = sys.argv[1]
-manifest = None
-with open(manifest_path) as f:
-    manifest = f.read()
-parent_path = pathlib.Path(manifest_path).parent
-
-#EXT-X-KEY:METHOD=AES-128,URI="level-00950400-0288p/K74052.key",IV=0x00000000000000000000000000012148,KEYFORMATVERSIONS="1"
-PATTERNS = {}
-PATTERNS['ENCRYPTION_METHOD'] = '(?:METHOD=)([0-9a-zA-Z-]+)'
-PATTERNS['ENCRYPTION_IV'] = '(?:IV=0x)([0-9a-zA-Z]+)'
-PATTERNS['ENCRYPTION_KEY_FORMAT_VERSION'] = '(?:KEYFORMATVERSIONS=")([0-9]+)(?:")'
-PATTERNS['ENCRYPTION_KEY_PATH'] = '(?:URI=\")([0-9a-zA-Z-./]+)(?:")'
-
-encryption_key = None
-for line in manifest.splitlines():
-    if line.startswith('#EXT-X-KEY:METHOD=NONE'):
+def get_jobs(playlist, parent_path, output, encryption_keys):
+    for segment in playlist.segments:
         encryption_key = None
-    elif line.startswith('#EXT-X-KEY:METHOD=AES-128'):
-        encryption_method = Util.regex_once(PATTERNS['ENCRYPTION_METHOD'], line)
-        encryption_iv = Util.regex_once(PATTERNS['ENCRYPTION_IV'], line)
-        encryption_iv = bytes.fromhex(encryption_iv)
-        encryption_key_version = Util.regex_once(PATTERNS['ENCRYPTION_KEY_FORMAT_VERSION'], line)
-        encryption_key_path = Util.regex_once(PATTERNS['ENCRYPTION_KEY_PATH'], line)
-        encryption_key_path = parent_path.joinpath(encryption_key_path)
+        encryption_iv = None
+        if segment.key is not None and segment.key.method == 'AES-128':
+            encryption_key = encryption_keys[segment.key.uri]
+            encryption_iv = segment.key.get_iv(segment.sequence)
 
-        encryption_key = None
-        with open(encryption_key_path, 'rb') as f:
-            encryption_key = f.read()
-
-        # print(encryption_method)
-        # print(encryption_iv)
-        # print(encryption_key_version)
-        # print(encryption_key_path)
-    elif line.endswith('.ts'):
-        filepath = line
+        filepath = segment.uri
         encrypted_filepath = parent_path.joinpath(filepath)
         decrypted_filepath = output.joinpath(filepath)
+        yield encrypted_filepath, decrypted_filepath, encryption_key, encryption_iv
+
+
+def decrypt_fragment(job):
+    encrypted_filepath, decrypted_filepath, encryption_key, encryption_iv = job
+    Util.make_directory(decrypted_filepath.parent)
+    if encryption_key is None:
+        shutil.copyfile(encrypted_filepath, decrypted_filepath)
+    else:
+        hls_crypto.decrypt_file(encrypted_filepath, decrypted_filepath, encryption_key, encryption_iv)
+    return decrypted_filepath
+
+
+def main(args):
+    output = pathlib.Path(args.output)
+    Util.delete_directory(output)
+    Util.make_directory(output)
+
+    manifest_path = args.manifest
+    manifest = None
+    with open(manifest_path) as f:
+        manifest = f.read()
+    parent_path = pathlib.Path(manifest_path).parent
+
+    playlist = MediaPlaylist(manifest)
+    encryption_keys = hls_crypto.read_keys(playlist, parent_path)
+    jobs = get_jobs(playlist, parent_path, output, encryption_keys)
 
-        encrypted_data = None
-        with open(encrypted_filepath, 'rb') as f:
-            encrypted_data = f.read()
+    if args.jobs == 1:
+        for job in jobs:
+            logging.debug(f'decrypted - {decrypt_fragment(job)}')
+        return
 
-        if encryption_key is None:
-            decrypted_data = encrypted_data
-        else:
-            # https://stackoverflow.com/a/67627186
-            cipher = AES.new(encryption_key, AES.MODE_CBC, IV=encryption_iv)
-            decrypted_data = cipher.decrypt(encrypted_data)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for decrypted_filepath in pool.map(decrypt_fragment, jobs, chunksize=args.chunksize):
+            logging.debug(f'decrypted - {decrypted_filepath}')
 
-        Util.make_directory(decrypted_filepath.parent)
-        with open(decrypted_filepath, 'wb') as f:
-            f.write(decrypted_data)
 
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
 
+    parser = ArgumentParser()
+    parser.description = 'Decrypt the AES-128 fragments of a localised level manifest'
+    parser.add_argument('manifest',
+                        help='localised level manifest, eg ./localised-level-00950400-0288p.m3u8')
+    parser.add_argument('-o', '--output',
+                        help='directory for the decrypted fragments',
+                        default='.output')
+    parser.add_argument('-j', '--jobs',
+                        help='decryption processes, 1 decrypts in this process',
+                        default=os.cpu_count(),
+                        type=int)
+    parser.add_argument('--chunksize',
+                        help='fragments handed to a process at a time',
+                        default=16,
+                        type=int)
+    parser.add_argument("-d", "--debug",
+                        help="Enable debug",
+                        action="store_const",
+                        dest='loglevel',
+                        const=logging.DEBUG,
+                        default=logging.INFO)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.loglevel)
+    main(args)
@@ -10,9 +10,31 @@ import datetime
 import re
 import json
 import pathlib
+import sqlite3
+import hashlib
+import mmap
+import gzip
+import zlib
 from urllib.parse import urlparse
+import asyncio
 import concurrent.futures
-from time import sleep
+import itertools
+import queue
+import threading
+from time import monotonic, perf_counter, sleep
+import socket
+import atexit
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import hls_parser
+import hls_crypto
+from hls_cache import FragmentCache
+from hls_metrics import Metrics
+import hls_export
 
 
 class Matcher:
@@ -45,19 +67,263 @@ class Matcher:
             shutil.rmtree(directory_path)
 
 
+class RequestTimer:
+    # connection setup timings of the request running on this thread, filled
+    # in by the timed urllib3 connections below
+    local = threading.local()
+    getaddrinfo = socket.getaddrinfo
+
+    def reset():
+        RequestTimer.local.timings = {}
+
+    def add(name, seconds):
+        timings = getattr(RequestTimer.local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + seconds
+
+    def get():
+        return dict(getattr(RequestTimer.local, 'timings', {}))
+
+    def timed_getaddrinfo(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return RequestTimer.getaddrinfo(*args, **kwargs)
+        finally:
+            RequestTimer.add('dns', perf_counter() - started)
+
+    def install():
+        # urllib3 resolves through socket.getaddrinfo, only wrapped when
+        # metrics are enabled
+        socket.getaddrinfo = RequestTimer.timed_getaddrinfo
+
+
+class ConnectionTimer:
+    def _new_conn(self):
+        before = RequestTimer.get()
+        started = perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            dns = RequestTimer.get().get('dns', 0) - before.get('dns', 0)
+            RequestTimer.add('connect', perf_counter() - started - dns)
+
+    def connect(self):
+        before = RequestTimer.get()
+        started = perf_counter()
+        super().connect()
+        if not isinstance(self, HTTPSConnection):
+            return
+        after = RequestTimer.get()
+        setup = sum(after.get(name, 0) - before.get(name, 0) for name in ['dns', 'connect'])
+        RequestTimer.add('tls', max(0, perf_counter() - started - setup))
+
+
+class TimedHTTPConnection(ConnectionTimer, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(ConnectionTimer, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+class HttpSession:
+    # one requests.Session shared by every Downloader, so manifests, keys and
+    # fragments reuse keep-alive connections from a per host pool
+    POOL_SIZE = 10
+    RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    RETRY_STATUSES = [500, 502, 503, 504]
+
+    session = None
+    lock = threading.Lock()
+
+    def configure(pool_size=None, retries=None, backoff_factor=None):
+        with HttpSession.lock:
+            if pool_size is not None:
+                HttpSession.POOL_SIZE = pool_size
+            if retries is not None:
+                HttpSession.RETRIES = retries
+            if backoff_factor is not None:
+                HttpSession.BACKOFF_FACTOR = backoff_factor
+            HttpSession.session = None
+
+    def get_session():
+        with HttpSession.lock:
+            if HttpSession.session is None:
+                HttpSession.session = HttpSession.create_session()
+            return HttpSession.session
+
+    def create_session():
+        retry = Retry(total=HttpSession.RETRIES,
+                      connect=HttpSession.RETRIES,
+                      read=HttpSession.RETRIES,
+                      status=HttpSession.RETRIES,
+                      backoff_factor=HttpSession.BACKOFF_FACTOR,
+                      status_forcelist=HttpSession.RETRY_STATUSES,
+                      allowed_methods=['GET', 'HEAD'],
+                      raise_on_status=False)
+        adapter = TimedHTTPAdapter(pool_connections=HttpSession.POOL_SIZE,
+                                   pool_maxsize=HttpSession.POOL_SIZE,
+                                   max_retries=retry,
+                                   pool_block=True)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        logging.debug(f'http session - pool size {HttpSession.POOL_SIZE} - retries {HttpSession.RETRIES}')
+        return session
+
+    def get(url, **kwargs):
+        return HttpSession.get_session().get(url, **kwargs)
+
+    def head(url, **kwargs):
+        return HttpSession.get_session().head(url, **kwargs)
+
+
+class TokenBucket:
+    # byte rate limiter shared between threads, a consumer may overdraw the
+    # bucket and then sleeps until the debt has been refilled
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+    def from_mbps(mbps):
+        if not mbps:
+            return None
+        return TokenBucket(mbps * 1000 * 1000 / 8)
+
+
+class DownloadIndex:
+    # sqlite index of every fragment and key saved in a capture directory, so
+    # a restarted capture only refetches files that are missing or truncated
+    FILENAME = '.download-index.sqlite3'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    def __init__(self, directory, verify=False):
+        self.verify = verify
+        self.lock = threading.Lock()
+        Matcher.make_directory_recursive(directory)
+        self.path = os.path.join(directory, self.FILENAME)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS downloads '
+                                    '(path TEXT PRIMARY KEY, url TEXT, size INTEGER, sha256 TEXT, status TEXT, '
+                                    'updated REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+
+    def get(self, path):
+        with self.lock:
+            return self.connection.execute('SELECT url, size, sha256, status FROM downloads WHERE path = ?',
+                                           (str(path),)).fetchone()
+
+    def record(self, path, url, size, sha256, status):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)',
+                                    (str(path), url, size, sha256, status, datetime.datetime.now().timestamp()))
+
+    def is_complete(self, path):
+        row = self.get(path)
+        if row is None or row[3] != self.COMPLETE:
+            return False
+        url, size, sha256, status = row
+        filepath = pathlib.Path(path)
+        if not filepath.is_file() or filepath.stat().st_size != size:
+            return False
+        if self.verify and DownloadIndex.get_sha256(filepath) != sha256:
+            return False
+        return True
+
+    def get_sha256(filepath):
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(Downloader.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_state(self, name):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (name, str(value)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
 class Downloader:
-    def __init__(self, url, filepath=None, delete_existing=False):
+    # fragments are streamed through a fixed size buffer into a
+    # temporary file, manifests and keys are small enough to keep in memory
+    CHUNK_SIZE = 64 * 1024
+    PARTIAL_SUFFIX = '.part'
+
+    # hls_metrics.Metrics shared by every download, set up in main()
+    metrics = None
+
+    def __init__(self, url, filepath=None, delete_existing=False, stream=False, headers=None, save=True, decrypt=None,
+                 index=None, cache=None, rate_limits=(), kind='fragment', level=None):
         self.url = url
         if filepath is None:
-            self.filepath = pathlib.PurePath(urlparse(self.url).path).name
+            filepath = pathlib.PurePath(urlparse(self.url).path).name
         self.filepath = pathlib.PurePath(filepath)
         self.filename = self.filepath.name
         self.directory_path = self.filepath.parent
+        self.stream = stream
+        self.headers = headers
+        self.save_to_disk = save
+        # (key future, iv) to decrypt an AES-128 fragment while it streams in
+        self.decrypt = decrypt
+        self.index = index
+        self.cache = cache if stream else None
+        self.rate_limits = rate_limits
+        self.kind = kind
+        self.level = level
 
         logging.debug(f'filepath {self.filepath}')
         logging.debug(f'directory_path {self.directory_path}')
 
-        self.response = None
+        self.ok = False
+        self.not_modified = False
+        self.body = None
+        self.encoding = None
+        self.etag = None
+        self.last_modified = None
+        self.status = None
+        self.received = 0
+        self.timings = {}
         self.delete_existing(delete_existing)
         self.download()
 
@@ -74,69 +340,509 @@ class Downloader:
         pathlib.Path(self.directory_path).mkdir(parents=True, exist_ok=True)
 
     def download(self):
-        if pathlib.Path(self.filepath).exists():
+        if self.save_to_disk and self.is_downloaded():
             logging.debug(f'already downloaded - {self.filepath}')
+            self.ok = True
+            return
+        if self.cache and self.link_from_cache():
+            self.ok = True
             return
 
         logging.info(f'downloading - {self.filepath} - {self.url}')
-        r = requests.get(self.url)
-        if r.ok:
-            self.response = r
+        RequestTimer.reset()
+        started = perf_counter()
+        try:
+            self.fetch()
+        except (requests.exceptions.RequestException, OSError) as e:
+            logging.error(f'download failed: {self.filepath} - {self.url} - {e}')
+            self.ok = False
+            if self.index:
+                self.index.record(self.filepath, self.url, None, None, DownloadIndex.FAILED)
+        finally:
+            self.record_metrics(perf_counter() - started)
+
+    def fetch(self):
+        with HttpSession.get(self.url, stream=self.stream, headers=self.headers) as r:
+            self.status = r.status_code
+            self.timings['ttfb'] = r.elapsed.total_seconds()
+            if r.status_code == 304:
+                logging.debug(f'not modified - {self.filepath} - {self.url}')
+                self.not_modified = True
+                self.ok = True
+                return
+            if not r.ok:
+                logging.error(f'download failed: {self.filepath} - {self.url} - {r.status_code}')
+                return
+            self.etag = r.headers.get('ETag')
+            self.last_modified = r.headers.get('Last-Modified')
+            if not self.save_to_disk:
+                self.body = r.content
+                self.encoding = r.encoding
+                self.received = len(self.body)
+                self.ok = True
+                return
             logging.info(f'saving - {self.filepath}')
             self.make_directory()
-            with open(self.filepath, 'wb') as f:
-                f.write(r.content)
-        else:
-            logging.error(f'download failed: {self.filepath} - {self.url}')
+            if self.stream:
+                self.save_stream(r)
+            else:
+                self.save(r)
+        self.ok = True
+
+    def record_metrics(self, total):
+        if self.metrics is None:
+            return
+        timings = RequestTimer.get()
+        timings.update(self.timings)
+        timings['total'] = total
+        self.metrics.record_request(self.kind, self.url, self.filepath, self.status if self.ok else None,
+                                    self.received, timings, 'connect' not in timings, self.level)
+
+    def is_downloaded(self):
+        if not pathlib.Path(self.filepath).exists():
+            return False
+        if self.index is None:
+            return True
+        if self.index.is_complete(self.filepath):
+            return True
+        logging.info(f'incomplete, downloading again - {self.filepath}')
+        return False
+
+    def get_cache_key(self):
+        # cleartext written by a decrypting download is cached apart from the
+        # ciphertext of the same url
+        if self.decrypt:
+            return f'{self.url} decrypted'
+        return self.url
+
+    def is_cache_fresh(self, etag):
+        # a cached url is reused only while the origin still has the same
+        # ETag, urls served without one are taken to be immutable
+        if not etag:
+            return True
+        try:
+            r = HttpSession.head(self.url, headers={'If-None-Match': etag}, allow_redirects=True)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'cache revalidation failed: {self.filepath} - {e}')
+            return False
+        if r.status_code == 304 or (r.ok and r.headers.get('ETag') == etag):
+            return True
+        logging.info(f'cache entry is stale - {self.filepath}')
+        return False
+
+    def link_from_cache(self):
+        key = self.get_cache_key()
+        etag = self.cache.get_etag(key)
+        if etag is None or not self.is_cache_fresh(etag):
+            return False
+        try:
+            cached = self.cache.link(key, self.filepath)
+        except OSError as e:
+            logging.warning(f'cache link failed: {self.filepath} - {e}')
+            return False
+        if cached is None:
+            return False
+        logging.info(f'linked from cache - {self.filepath}')
+        if self.index:
+            sha256, size = cached
+            self.index.record(self.filepath, self.url, size, sha256, DownloadIndex.COMPLETE)
+        return True
+
+    def save(self, r):
+        self.body = r.content
+        self.encoding = r.encoding
+        self.received = len(self.body)
+        self.write()
+
+    def write(self):
+        self.make_directory()
+        with open(self.filepath, 'wb') as f:
+            f.write(self.body)
+
+    def save_stream(self, r):
+        partial_path = f'{self.filepath}{self.PARTIAL_SUFFIX}'
+        decryptor = self.get_decryptor()
+        digest = hashlib.sha256()
+        size = 0
+        writing = 0
+        try:
+            with open(partial_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                    self.received += len(chunk)
+                    for rate_limit in self.rate_limits:
+                        rate_limit.consume(len(chunk))
+                    if decryptor:
+                        chunk = decryptor.update(chunk)
+                    digest.update(chunk)
+                    started = perf_counter()
+                    size += f.write(chunk)
+                    writing += perf_counter() - started
+                if decryptor:
+                    chunk = decryptor.finalize()
+                    digest.update(chunk)
+                    size += f.write(chunk)
+            self.timings['write'] = writing
+            self.check_length(r, self.received)
+            os.replace(partial_path, self.filepath)
+        except BaseException:
+            pathlib.Path(partial_path).unlink(missing_ok=True)
+            raise
+
+        if self.index:
+            self.index.record(self.filepath, self.url, size, digest.hexdigest(), DownloadIndex.COMPLETE)
+        if self.cache:
+            self.cache.store(self.get_cache_key(), self.url, self.etag, self.filepath, digest.hexdigest(), size)
+
+    def check_length(self, r, received):
+        length = r.headers.get('Content-Length')
+        if length is None or r.headers.get('Content-Encoding'):
+            return
+        if int(length) != received:
+            raise OSError(f'truncated, received {received} of {length} bytes')
+
+    def get_decryptor(self):
+        if self.decrypt is None:
+            return None
+        # the scheduler waits on the key before this download takes a host
+        # slot, so the future is settled and reading it never blocks
+        key_download, iv = self.decrypt
+        key = key_download.result(timeout=0)
+        return hls_crypto.Aes128Decryptor(key, iv, self.filepath)
 
     def text(self):
-        return self.response.text
+        if self.body is None:
+            return None
+        return self.body.decode(self.encoding or 'utf-8', errors='replace')
 
     def content(self):
-        return self.response.content
+        if self.body is None and self.stream and self.ok:
+            with open(self.filepath, 'rb') as f:
+                return f.read()
+        return self.body
+
+
+class DownloadScheduler:
+    # global worker pool shared by every level, fragment and key jobs are
+    # queued here and fetched in parallel with a concurrency cap per host
+    WORKERS = 8
+    PER_HOST = 4
+
+    def __init__(self, workers=WORKERS, per_host=PER_HOST, cache=None):
+        self.queue = queue.PriorityQueue()
+        self.cache = cache
+        self.counter = itertools.count()
+        self.per_host = per_host
+        self.host_limits = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, name=f'download-{i}', daemon=True)
+                        for i in range(workers)]
+        [thread.start() for thread in self.threads]
+
+    def submit(self, url, filepath, priority=0, depends=None, **kwargs):
+        # a path already queued or downloading shares the pending future
+        with self.lock:
+            future = self.in_flight.get(str(filepath))
+            if future is not None:
+                return future
+            future = concurrent.futures.Future()
+            self.in_flight[str(filepath)] = future
+        if depends:
+            kwargs['depends'] = depends
+        self.queue.put((priority, next(self.counter), url, filepath, kwargs, future))
+        return future
+
+    def work(self):
+        while True:
+            priority, _, url, filepath, kwargs, future = self.queue.get()
+            if future is None:
+                return
+            if future.set_running_or_notify_cancel():
+                try:
+                    # jobs like a fragment waiting for its key block before
+                    # taking a host slot, so they never starve the key fetch
+                    self.wait(kwargs.pop('depends', []))
+                    if kwargs.get('stream'):
+                        kwargs.setdefault('cache', self.cache)
+                    with self.host_limit(url):
+                        future.set_result(Downloader(url, filepath=filepath, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.lock:
+                self.in_flight.pop(str(filepath), None)
+
+    def host_limit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_limits[host]
+
+    def wait(self, futures):
+        concurrent.futures.wait(futures)
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.queue.put((float('inf'), next(self.counter), None, None, None, None))
+        [thread.join() for thread in self.threads]
+        if self.cache:
+            self.cache.close()
 
 
 class Uptime:
+    PATTERN = re.compile("(^[0-9]*:[0-9]*:[0-9]*.[0-9]*)")
+
     def __init__(self):
         self.uptime = 0
 
     def find_and_update(self, raw):
-        pattern = "(^[0-9]*:[0-9]*:[0-9]*.[0-9]*)"
-        self.uptime = self.find(pattern, raw)
+        self.uptime = self.find(self.PATTERN, raw)
 
     def find(self, pattern, raw):
-        match = re.search(pattern, raw)
+        match = pattern.match(raw)
         if match:
             return match.groups()[0]
         return self.uptime
 
 
+class LogScanner:
+    # reads a local or http WPE log line by line without loading it whole,
+    # follow keeps polling for appended lines like tail -f
+    PLAYBACK_MARKER = 'setPlaybackInformation'
+    PLAYBACK_URL_PATTERN = re.compile(r'setPlaybackInformation.*?"url"\s*:\s*"((?:[^"\\]|\\.)*)"')
+    CHUNK_SIZE = 1024 * 1024
+    FOLLOW_INTERVAL = 1
+
+    def __init__(self, source, follow=False, use_mmap=False, logfile=None):
+        self.source = source
+        self.follow = follow
+        self.use_mmap = use_mmap
+        self.logfile = logfile
+        self.uptime = Uptime()
+
+    def is_url(self):
+        return self.source.startswith('http://') or self.source.startswith('https://')
+
+    def scan(self, on_playback):
+        for line in self.read_url() if self.is_url() else self.read_file():
+            self.uptime.find_and_update(line)
+            if self.PLAYBACK_MARKER not in line:
+                continue
+            url = self.get_playback_url(line)
+            if url:
+                on_playback(url)
+
+    def get_playback_url(self, line):
+        match = self.PLAYBACK_URL_PATTERN.search(line)
+        if match:
+            return json.loads(f'"{match.group(1)}"')
+        # fall back to the whole json payload for unusual layouts
+        try:
+            return json.loads(Matcher.find_once("({.*})", line)).get('url')
+        except (TypeError, ValueError, AttributeError):
+            logging.warning(f'cannot parse playback information: {line}')
+
+    def split_lines(self, chunks, pending=b''):
+        # yields complete lines, a trailing partial line is handed back through
+        # self.pending so a follow read can complete it later
+        for chunk in chunks:
+            pending += chunk
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', errors='replace').rstrip('\r')
+        self.pending = pending
+
+    def read_file(self):
+        if self.follow:
+            yield from self.follow_file()
+        elif self.use_mmap:
+            yield from self.read_mmap()
+        else:
+            with open(self.source, 'r', errors='replace', buffering=self.CHUNK_SIZE) as f:
+                for line in f:
+                    yield line.rstrip('\r\n')
+
+    def read_mmap(self):
+        with open(self.source, 'rb') as f:
+            # an empty file cannot be mapped and has no lines anyway
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for line in iter(m.readline, b''):
+                    yield line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def follow_file(self):
+        self.pending = b''
+        with open(self.source, 'rb') as f:
+            while True:
+                yield from self.split_lines(iter(lambda: f.read(self.CHUNK_SIZE), b''), self.pending)
+                if os.fstat(f.fileno()).st_size < f.tell():
+                    logging.info(f'log truncated, reading from the start - {self.source}')
+                    f.seek(0)
+                    self.pending = b''
+                sleep(self.FOLLOW_INTERVAL)
+
+    def read_url(self):
+        # http logs are read with ranged requests from the last offset, and
+        # copied to self.logfile as they arrive
+        self.pending = b''
+        offset = 0
+        log = None
+        if self.logfile:
+            Matcher.make_directory_recursive(pathlib.Path(self.logfile).parent)
+            log = open(self.logfile, 'ab')
+        try:
+            while True:
+                headers = {'Range': f'bytes={offset}-'} if offset else None
+                with HttpSession.get(self.source, stream=True, headers=headers) as r:
+                    if r.status_code == 416:
+                        chunks = []
+                    elif not r.ok:
+                        logging.error(f'download failed: {self.source} - {r.status_code}')
+                        return
+                    else:
+                        chunks = r.iter_content(chunk_size=self.CHUNK_SIZE)
+                        if offset and r.status_code != 206:
+                            chunks = self.skip(chunks, offset)
+                    for chunk in chunks:
+                        offset += len(chunk)
+                        if log:
+                            log.write(chunk)
+                        yield from self.split_lines([chunk], self.pending)
+                if not self.follow:
+                    break
+                if log:
+                    log.flush()
+                sleep(self.FOLLOW_INTERVAL)
+            if self.pending:
+                yield self.pending.decode('utf-8', errors='replace')
+        finally:
+            if log:
+                log.close()
+
+    def skip(self, chunks, length):
+        # the server ignored the range header, drop what we already read
+        for chunk in chunks:
+            if length >= len(chunk):
+                length -= len(chunk)
+                continue
+            yield chunk[length:]
+            length = 0
+
+
+class ManifestWriter:
+    # the localised manifest and the raw playlist history of a level stay open
+    # for the whole capture, each poll adds to them in memory and they are
+    # written out at most every FLUSH_INTERVAL seconds and when the level ends
+    FLUSH_INTERVAL = 10
+    HISTORY_SUFFIX = '.history.gz'
+
+    def __init__(self, path, history_path):
+        self.path = path
+        self.history_path = history_path
+        self.file = None
+        self.history = None
+        self.pending = []
+        self.last_flush = monotonic()
+
+    def write(self, contents):
+        # True when the batch went to disk
+        self.pending.extend(contents)
+        if monotonic() - self.last_flush < self.FLUSH_INTERVAL:
+            return False
+        self.flush()
+        return True
+
+    def is_empty(self):
+        return not self.pending and self.file is None and not pathlib.Path(self.path).exists()
+
+    def record(self, url, body):
+        # one snapshot per poll, zcat gives back every playlist in order
+        if self.history is None:
+            Matcher.make_directory_recursive(pathlib.Path(self.history_path).parent)
+            self.history = gzip.open(self.history_path, 'ab')
+        self.history.write(f'#HLS-LOCALISE-SNAPSHOT:{datetime.datetime.now().isoformat()},{url}\n'.encode())
+        self.history.write(body if body.endswith(b'\n') else body + b'\n')
+
+    def flush(self):
+        self.last_flush = monotonic()
+        if self.pending:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write('\n'.join(self.pending) + '\n')
+            self.file.flush()
+            self.pending = []
+        if self.history is not None:
+            # a sync flush leaves the history readable up to here even if
+            # the capture is killed
+            self.history.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.history is not None:
+            self.history.close()
+            self.history = None
+
+    def discard(self):
+        # a precached run rewrites the localised manifest from scratch
+        self.pending = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        pathlib.Path(self.path).unlink(missing_ok=True)
+
+
 class HlsLevel:
-    PATTERNS = {}
-    PATTERNS['BANDWIDTH'] = "(?:BANDWIDTH=)([0-9]+)"
-    PATTERNS['CODECS'] = "(?:CODECS=\")([0-9a-zA-Z,.]+)"
-    PATTERNS['RESOLUTION'] = "(?:RESOLUTION=)([0-9]+)(?:x)([0-9]+)"
-    PATTERNS['HDCP_LEVEL'] = "(?:HDCP-LEVEL=)([0-9a-zA-Z.]+)"
-    PATTERNS['SUBTITLES'] = "(?:SUBTITLES=\")([0-9a-zA-Z]+)"
-    PATTERNS['EXT_X_MEDIA_SEQUENCE'] = "(?:#EXT-X-MEDIA-SEQUENCE:)([0-9]+)"
-
-    def __init__(self, parent_directory, raw, url, duration):
-        self.url = url
+    # scheduler priorities, lower runs first, playlists and keys always go
+    # ahead of fragments so the live edge is never starved
+    MANIFEST_PRIORITY = -2
+    PRIORITY_LEVEL = -1
+    DEFAULT_PRIORITY = 0
+
+    # used until the first playlist tells us its target duration
+    DEFAULT_TARGET_DURATION = 10
+
+    def __init__(self, parent_directory, variant, duration, scheduler, decrypt=False, index=None):
+        self.url = variant.uri
         self.duration = duration
+        self.scheduler = scheduler
+        self.decrypt = decrypt
+        self.index = index
         self.precached_level = None
+        self.priority = self.DEFAULT_PRIORITY
+        self.rate_limits = ()
 
-        self.bandwidth = Matcher.find_once(self.PATTERNS['BANDWIDTH'], raw)
-        self.codecs = Matcher.find_once(self.PATTERNS['CODECS'], raw)
-        resolution = re.search(self.PATTERNS['RESOLUTION'], raw)
-        self.width = resolution.groups()[0]
-        self.height = resolution.groups()[1]
-        self.hdcp_required = Matcher.find_once(self.PATTERNS['HDCP_LEVEL'], raw)
-        self.subtitles = Matcher.find_once(self.PATTERNS['SUBTITLES'], raw)
+        self.bandwidth = variant.bandwidth
+        self.codecs = variant.codecs
+        self.width = variant.width
+        self.height = variant.height
+        self.hdcp_required = variant.hdcp_level
+        self.subtitles = variant.subtitles
 
         # other variables to be intialised
-        self.manifest_start_sequence_counter = 0
-        self.manifest_end_sequence_counter = 0
-        self.fragment_sequence_counter = 0
+        self.last_sequence = None
+        self.discontinuity_sequence = None
+        self.localised_key = None
+        self.localised_key_line = None
+        # set once the localised media sequence drifts from the source
+        self.explicit_iv = False
+        # the first load of a resumed capture refetches what is missing
+        self.resuming = False
+        self.key_path = None
+        self.key_download = None
+        self.target_duration = self.DEFAULT_TARGET_DURATION
+        self.endlist = False
+        # EXT-X-ENDLIST is in the localised manifest
+        self.ended = False
+        self.previous_manifest = None
+        self.etag = None
+        self.last_modified = None
+        # wall clock end of the newest segment, from EXT-X-PROGRAM-DATE-TIME
+        self.live_edge = None
 
         # local paths
         self.manifest_filename = f'level-{int(self.bandwidth):08}-{int(self.height):04}p.m3u8'
@@ -144,126 +850,415 @@ class HlsLevel:
         self.directory = os.path.join(parent_directory, self.manifest_filename.replace('.m3u8', ''))
         self.manifest_path = os.path.join(self.parent_directory, self.manifest_filename)
         self.localised_manifest_path = os.path.join(self.parent_directory, f'localised-{self.manifest_filename}')
+        self.writer = ManifestWriter(self.localised_manifest_path, self.manifest_path + ManifestWriter.HISTORY_SUFFIX)
+        self.load_state()
+
+    def load_state(self):
+        # a resumed live capture carries on after the last segment it wrote
+        if self.index is None or self.url is None:
+            return
+        last_sequence = self.index.get_state(f'{self.manifest_filename}:last_sequence')
+        discontinuity_sequence = self.index.get_state(f'{self.manifest_filename}:discontinuity_sequence')
+        explicit_iv = self.index.get_state(f'{self.manifest_filename}:explicit_iv')
+        if last_sequence is not None and pathlib.Path(self.localised_manifest_path).exists():
+            self.last_sequence = int(last_sequence)
+            self.discontinuity_sequence = int(discontinuity_sequence)
+            self.explicit_iv = explicit_iv == '1'
+            self.ended = self.index.get_state(f'{self.manifest_filename}:ended') == '1'
+            self.resuming = True
+            logging.info(f'{self.bandwidth} - resuming after media sequence {self.last_sequence}')
+
+    def save_state(self):
+        if self.index is None or self.url is None or self.last_sequence is None:
+            return
+        self.index.set_state(f'{self.manifest_filename}:last_sequence', self.last_sequence)
+        self.index.set_state(f'{self.manifest_filename}:discontinuity_sequence', self.discontinuity_sequence)
+        self.index.set_state(f'{self.manifest_filename}:explicit_iv', int(self.explicit_iv))
+        self.index.set_state(f'{self.manifest_filename}:ended', int(self.ended))
 
     def start_download(self):
-        interval = 10
-        for loop in range(self.duration):
-            contents = Downloader(self.url,
-                                  self.manifest_path.replace('.m3u8', f'-{Matcher.get_datetime_stamp()}.m3u8')).text()
-            self.parse_and_download(contents)
-
-            if loop + 1 == self.duration:
-                logging.debug(f'{self.bandwidth} - {loop + 1}/{self.duration} finished')
-            elif self.duration > 1:
-                logging.debug(f'{self.bandwidth} - {loop + 1}/{self.duration} begin sleeping for {interval}')
-                sleep(interval)
-
-    def find_startswiths(self, patterns, text):
-        for pattern in patterns:
-            if text.startswith(pattern):
-                return True
-
-    HLS_HEADER_INIT_PATTERNS = ["#EXTM3U", "#EXT-X-TARGETDURATION", "#EXT-X-VERSION", "#EXT-X-DISCONTINUITY-SEQUENCE",
-                           "#EXT-X-MEDIA-SEQUENCE", "#EXT-X-PROGRAM-DATE-TIME"]
-    HLS_HEADER_ONGOING_PATTERNS = ["#EXT-X-DISCONTINUITY", "#EXT-X-PROGRAM-DATE-TIME", '#EXTINF']
-    HLS_VIDEO_PATTERNS = ['https://', '#EXT-X-KEY', '#EXTINF']
-    HLS_VIDEO_HEADER_PATTERNS = ['#EXT-X-KEY', '#EXTINF']
+        deadline = monotonic() + self.duration
+        try:
+            while True:
+                started = monotonic()
+                manifest = self.fetch_manifest()
+                changed = self.update_manifest(manifest)
+                if changed:
+                    self.parse_and_download(manifest.text())
+
+                delay = self.get_reload_delay(changed, started)
+                if self.is_finished(deadline, delay):
+                    break
+                sleep(delay)
+        finally:
+            self.close_manifest()
+
+    async def start_async_download(self):
+        # same polling loop as start_download, but as a coroutine so every level
+        # of every channel shares one event loop instead of a thread each
+        deadline = monotonic() + self.duration
+        try:
+            while True:
+                started = monotonic()
+                manifest = await asyncio.wrap_future(self.scheduler.submit(self.url, self.manifest_path,
+                                                                           priority=self.MANIFEST_PRIORITY,
+                                                                           headers=self.get_conditional_headers(),
+                                                                           save=False, kind='manifest',
+                                                                           level=self.manifest_filename))
+                changed = self.update_manifest(manifest)
+                if changed:
+                    await self.parse_and_download_async(manifest.text())
+
+                delay = self.get_reload_delay(changed, started)
+                if self.is_finished(deadline, delay):
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            self.close_manifest()
+
+    def fetch_manifest(self):
+        return Downloader(self.url, self.manifest_path, headers=self.get_conditional_headers(), save=False,
+                          kind='manifest', level=self.manifest_filename)
+
+    def get_conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def update_manifest(self, manifest):
+        if not manifest.ok:
+            return False
+        if manifest.not_modified or manifest.body == self.previous_manifest:
+            logging.debug(f'{self.bandwidth} - playlist unchanged')
+            return False
+
+        self.previous_manifest = manifest.body
+        self.etag = manifest.etag
+        self.last_modified = manifest.last_modified
+        self.writer.record(self.url, manifest.body)
+        return True
+
+    def get_reload_delay(self, changed, started):
+        # RFC 8216 6.3.4: reload after the target duration, or after half of it
+        # when the playlist has not changed since the last load
+        interval = self.target_duration if changed else self.target_duration / 2
+        return max(0, started + interval - monotonic())
+
+    def is_finished(self, deadline, delay):
+        if self.endlist:
+            logging.debug(f'{self.bandwidth} - playlist ended')
+            return True
+        if monotonic() + delay >= deadline:
+            logging.debug(f'{self.bandwidth} - finished')
+            return True
+        logging.debug(f'{self.bandwidth} - begin sleeping for {delay:.1f}')
+        return False
 
     def parse_and_download(self, contents):
+        contents_localised, downloads = self.localise(contents)
+        self.scheduler.wait(downloads)
+        self.write_localised(contents_localised)
+        self.record_lag()
+
+    async def parse_and_download_async(self, contents):
+        contents_localised, downloads = self.localise(contents)
+        # a failed key is logged by store_key and fails its fragments, it
+        # must not end the level
+        await asyncio.gather(*[asyncio.wrap_future(download) for download in downloads], return_exceptions=True)
+        self.write_localised(contents_localised)
+        self.record_lag()
+
+    def update_live_edge(self, segment):
+        if segment.program_date_time:
+            try:
+                program_date_time = datetime.datetime.fromisoformat(segment.program_date_time.partition(':')[2].replace('Z', '+00:00'))
+            except ValueError:
+                logging.warning(f'{self.bandwidth} - bad {segment.program_date_time}')
+                self.live_edge = None
+                return
+            if program_date_time.tzinfo is None:
+                program_date_time = program_date_time.replace(tzinfo=datetime.timezone.utc)
+            self.live_edge = program_date_time.timestamp()
+        elif self.live_edge is None:
+            return
+        self.live_edge += segment.duration or 0
+
+    def record_lag(self):
+        if Downloader.metrics is None or self.live_edge is None or self.endlist:
+            return
+        Downloader.metrics.record_lag(self.manifest_filename, datetime.datetime.now().timestamp() - self.live_edge)
+
+    def localise(self, contents):
+        playlist = self.parse_playlist(contents)
+        resumed_sequence = self.last_sequence if self.resuming else None
+        self.resuming = False
+        if playlist.target_duration:
+            self.target_duration = playlist.target_duration
+        self.endlist = playlist.endlist
+
         contents_localised = []
-        self.manifest_start_sequence_counter = self.get_media_sequence(contents)
-        self.fragment_sequence_counter = self.manifest_start_sequence_counter - 1
-        content_previous = None
-        for line_number, content in enumerate(contents.splitlines()):
-            if self.manifest_start_sequence_counter == 0 and \
-                    self.find_startswiths(self.HLS_HEADER_INIT_PATTERNS, content) and \
-                    line_number < 6:
-                contents_localised.append(content)
-                # contents_localised.append(f'LN164: {self.manifest_start_sequence_counter}' + content)
-
-            if self.find_startswiths(self.HLS_VIDEO_PATTERNS, content):
-                # content.startswith('#EXT-X-KEY'): AES Key URL
-                # content.startswith('#EXTINF'): Media Fragment URL coming next
-                # content.startswith('https://'): Media Fragment URL
-                if self.find_startswiths(self.HLS_VIDEO_HEADER_PATTERNS, content) \
-                        and not content_previous.startswith('#EXTINF') \
-                        and not content_previous.startswith('#EXT-X-KEY'):
-                    self.fragment_sequence_counter += 1
-                    if self.fragment_sequence_counter > self.manifest_end_sequence_counter:
-                        contents_localised.append('')
-                        contents_localised.append(f'#media sequence counter: {self.fragment_sequence_counter}/{self.manifest_end_sequence_counter}')
-                        # contents_localised.append(f'#media sequence counter: {self.fragment_sequence_counter}/{self.manifest_end_sequence_counter} - prev: {content_previous} curr: {content}')
-
-            if self.fragment_sequence_counter >= self.manifest_end_sequence_counter:
-                if self.find_startswiths(self.HLS_HEADER_ONGOING_PATTERNS, content):
-                    contents_localised.append(content)
-                    # contents_localised.append('LN167: ' + content)
-
-            if self.manifest_start_sequence_counter == 0 or \
-                    self.fragment_sequence_counter > self.manifest_end_sequence_counter:
-                if content.startswith('https://'):
-                    fragment_path = urlparse(content).path[1:]
-                    fragment_path = os.path.join(self.directory, fragment_path)
-                    Downloader(content, filepath=fragment_path)
-                    contents_localised.append(fragment_path)
-                elif content == '#EXT-X-KEY:METHOD=NONE':
-                    contents_localised.append(content)
-                    # contents_localised.append('LN191: ' + content)
-                elif content.startswith('#EXT-X-KEY') and 'URI="https://' in content:
-                    pattern = 'URI="(https:.+)",'
-                    url = Matcher.find_once(pattern, content)
-                    key_path = pathlib.Path(urlparse(url).path).name
-                    key_path = os.path.join(self.directory, key_path)
-                    Downloader(url, filepath=key_path)
-                    contents_localised.append(content.replace(url, key_path))
-            content_previous = content
-        contents_localised = [content.replace(self.parent_directory + '/', '') for content in contents_localised]
-        with open(self.localised_manifest_path, 'a') as f:
-            f.write('\n'.join(contents_localised) + '\n')
-        self.manifest_end_sequence_counter = self.fragment_sequence_counter
-
-    def get_media_sequence(self, raw):
-        return int(Matcher.find_once(self.PATTERNS['EXT_X_MEDIA_SEQUENCE'], raw))
+        downloads = []
+        if self.last_sequence is None and self.writer.is_empty():
+            contents_localised.extend(self.localise_header(playlist))
+
+        for segment in playlist.segments:
+            if resumed_sequence is not None and segment.sequence <= resumed_sequence:
+                # already in the localised manifest, the index skips the
+                # fragments that are complete and refetches the rest
+                self.localise_segment(segment, downloads)
+                continue
+            if self.last_sequence is not None and segment.sequence != self.last_sequence + 1:
+                logging.warning(f'{self.bandwidth} - media sequence jumped from {self.last_sequence} to {segment.sequence}')
+                segment.discontinuity = True
+                self.explicit_iv = True
+            contents_localised.extend(self.localise_segment(segment, downloads))
+            self.update_live_edge(segment)
+            self.last_sequence = segment.sequence
+
+        if playlist.endlist and not self.ended:
+            contents_localised.append('#EXT-X-ENDLIST')
+            self.ended = True
+        return contents_localised, downloads
+
+    def parse_playlist(self, contents):
+        after = None if self.resuming else self.last_sequence
+        playlist = hls_parser.MediaPlaylist(contents, self.url, after=after)
+        reset = self.last_sequence is not None and \
+            playlist.last_sequence is not None and \
+            (playlist.last_sequence < self.last_sequence or playlist.discontinuity_sequence < self.discontinuity_sequence)
+        if reset:
+            logging.warning(f'{self.bandwidth} - media sequence reset to {playlist.media_sequence}')
+            playlist = hls_parser.MediaPlaylist(contents, self.url)
+            if playlist.segments:
+                playlist.segments[0].discontinuity = True
+            self.last_sequence = None
+            self.explicit_iv = True
+        self.discontinuity_sequence = playlist.discontinuity_sequence
+        return playlist
+
+    def localise_header(self, playlist):
+        contents_localised = []
+        for content in playlist.header:
+            if content.startswith('#EXT-X-MEDIA-SEQUENCE') and playlist.segments:
+                content = f'#EXT-X-MEDIA-SEQUENCE:{playlist.segments[0].sequence}'
+            contents_localised.append(content)
+        return contents_localised
+
+    def localise_segment(self, segment, downloads):
+        contents_localised = []
+        key = segment.key.line if segment.key else None
+        key_changed = key != self.localised_key
+        if key_changed:
+            self.localised_key_line = self.localise_key(segment.key, downloads) if segment.key is not None else None
+            self.localised_key = key
+        decrypt = self.get_decrypt(segment)
+        if self.explicit_iv and not decrypt and segment.key is not None and segment.key.method == 'AES-128' and \
+                segment.key.iv is None:
+            # after a jump or reset the IV implied by the localised media
+            # sequence is wrong, the source sequence is written out instead
+            contents_localised.append(f'{self.localised_key_line},IV=0x{segment.sequence:032x}')
+        elif key_changed and self.localised_key_line is not None:
+            contents_localised.append(self.localised_key_line)
+        if segment.discontinuity:
+            contents_localised.append('#EXT-X-DISCONTINUITY')
+        if segment.program_date_time:
+            contents_localised.append(segment.program_date_time)
+        contents_localised.extend(segment.tags)
+        if segment.extinf:
+            contents_localised.append(segment.extinf)
+
+        fragment_path = urlparse(segment.uri).path[1:]
+        fragment_path = os.path.join(self.directory, fragment_path)
+        if decrypt:
+            downloads.append(self.scheduler.submit(segment.uri, fragment_path, priority=self.priority, stream=True,
+                                                   index=self.index, rate_limits=self.rate_limits,
+                                                   level=self.manifest_filename, decrypt=decrypt,
+                                                   depends=[self.key_download]))
+        else:
+            downloads.append(self.scheduler.submit(segment.uri, fragment_path, priority=self.priority, stream=True,
+                                                   index=self.index, rate_limits=self.rate_limits,
+                                                   level=self.manifest_filename))
+        contents_localised.append(os.path.relpath(fragment_path, self.parent_directory))
+        return contents_localised
+
+    def localise_key(self, key, downloads):
+        self.key_path = None
+        self.key_download = None
+        if key.url is None or key.url.startswith('data:'):
+            return key.line
+        key_path = self.get_key_path(key.url)
+        self.key_path = key_path
+        # every level of every capture shares one fetch per key uri, each
+        # level then makes sure the key file exists in its own capture
+        key_bytes = hls_crypto.KEYS.get_future(key.url, lambda future: self.fetch_key(key.url, key_path, future))
+        key_download = concurrent.futures.Future()
+        key_bytes.add_done_callback(lambda key_bytes: self.store_key(key.url, key_path, key_bytes, key_download))
+        self.key_download = key_download
+        downloads.append(self.key_download)
+        if self.can_decrypt(key):
+            return '#EXT-X-KEY:METHOD=NONE'
+        return key.localise(os.path.relpath(key_path, self.parent_directory))
+
+    def get_key_path(self, url):
+        # keys live once per capture under keys/, the url digest keeps keys
+        # with the same file name on different paths apart
+        digest = hashlib.sha256(url.encode()).hexdigest()[:12]
+        return os.path.join(self.parent_directory, 'keys', f'{digest}-{pathlib.Path(urlparse(url).path).name}')
+
+    def fetch_key(self, url, key_path, future):
+        download = self.scheduler.submit(url, key_path, priority=self.MANIFEST_PRIORITY, save=False, kind='key',
+                                         level=self.manifest_filename)
+        download.add_done_callback(lambda download: self.resolve_key(download, future))
+
+    def resolve_key(self, download, future):
+        try:
+            download = download.result()
+            if not download.ok:
+                raise OSError(f'key download failed: {download.url}')
+            future.set_result(download.body)
+        except Exception as e:
+            logging.error(f'{self.bandwidth} - {e}')
+            future.set_exception(e)
+
+    def store_key(self, url, key_path, key_bytes, future):
+        # the key file is only rewritten when it is missing or the fetch
+        # returned different bytes, levels of one capture share the path so
+        # the write goes through a per thread temporary file
+        try:
+            key = key_bytes.result()
+            if not pathlib.Path(key_path).is_file() or hls_crypto.read_file(key_path) != key:
+                Matcher.make_directory_recursive(pathlib.Path(key_path).parent)
+                partial_path = f'{key_path}.{threading.get_ident()}{Downloader.PARTIAL_SUFFIX}'
+                with open(partial_path, 'wb') as f:
+                    f.write(key)
+                os.replace(partial_path, key_path)
+            if self.index:
+                self.index.record(key_path, url, len(key), hashlib.sha256(key).hexdigest(), DownloadIndex.COMPLETE)
+            future.set_result(key)
+        except Exception as e:
+            future.set_exception(e)
+
+    def can_decrypt(self, key):
+        if not self.decrypt or not key.is_encrypted():
+            return False
+        if key.method != 'AES-128' or self.key_path is None:
+            logging.warning(f'{self.bandwidth} - cannot decrypt {key.method} on download, keeping encrypted fragments')
+            return False
+        return True
+
+    def get_decrypt(self, segment):
+        # (key future, iv) for fragments decrypted while they stream in
+        if not self.decrypt or segment.key is None or segment.key.method != 'AES-128' or self.key_download is None:
+            return None
+        return self.key_download, segment.key.get_iv(segment.sequence)
+
+    def write_localised(self, contents_localised):
+        # the resume state only moves once the segments are in the file
+        if self.writer.write(contents_localised):
+            self.save_state()
+
+    def close_manifest(self):
+        self.writer.close()
+        self.save_state()
+
+    def export(self, extension):
+        # one contiguous stream next to the localised manifest, fragments
+        # still encrypted are decrypted with the keys captured alongside them
+        if not pathlib.Path(self.localised_manifest_path).exists():
+            return
+        output = os.path.join(self.parent_directory, f'export-{self.manifest_filename.replace(".m3u8", "")}.{extension}')
+        logging.info(f'{self.bandwidth} - exporting {output}')
+        hls_export.export(self.localised_manifest_path, output)
 
     def start_precached_download(self):
         contents = None
-        contents_localised = []
         with open(self.precached_level, 'r') as f:
             contents = f.read()
+        # every run localises the whole manifest again, the index skips the
+        # fragments that are already complete
+        self.writer.discard()
+        self.parse_and_download(contents)
+        self.close_manifest()
 
-        for content in contents.splitlines():
-            if content.startswith('https://'):
-                fragment_path = urlparse(content).path[1:]
-                fragment_path = os.path.join(self.directory, fragment_path)
-                Downloader(content, filepath=fragment_path)
-                contents_localised.append(fragment_path)
-            elif content == '#EXT-X-KEY:METHOD=NONE':
-                contents_localised.append(content)
-                # contents_localised.append('LN225: ' + content)
-            elif content.startswith('#EXT-X-KEY') and 'URI="https://' in content:
-                pattern = 'URI="(https:.+)",'
-                url = Matcher.find_once(pattern, content)
-                key_path = pathlib.Path(urlparse(url).path).name
-                key_path = os.path.join(self.directory, key_path)
-                Downloader(url, filepath=key_path)
-                contents_localised.append(content.replace(url, key_path))
-            else:
-                contents_localised.append(content)
-        contents_localised = [content.replace(self.parent_directory + '/', '') for content in contents_localised]
-        with open(self.localised_manifest_path, 'a') as f:
-            f.write('\n'.join(contents_localised) + '\n')
+
+class LevelSelector:
+    def __init__(self, args):
+        self.mode = args.levels
+        if self.mode is None:
+            self.mode = 'all' if args.multithreading or args.asyncio else 'lowest'
+        self.min_bandwidth = args.min_bandwidth
+        self.max_bandwidth = args.max_bandwidth
+        self.min_height = args.min_height
+        self.max_height = args.max_height
+        self.codecs = args.codecs
+        self.priority_level = args.priority_level
+        self.rate_limit = TokenBucket.from_mbps(args.rate_limit)
+        self.level_rate_limit = args.level_rate_limit
+
+    def matches(self, level):
+        if self.min_bandwidth and level.bandwidth < self.min_bandwidth:
+            return False
+        if self.max_bandwidth and level.bandwidth > self.max_bandwidth:
+            return False
+        if self.min_height and level.height < self.min_height:
+            return False
+        if self.max_height and level.height > self.max_height:
+            return False
+        if self.codecs:
+            codecs = (level.codecs or '').split(',')
+            if not all(any(codec.startswith(wanted) for codec in codecs) for wanted in self.codecs.split(',')):
+                return False
+        return True
+
+    def select(self, levels):
+        levels = sorted([level for level in levels if self.matches(level)], key=lambda level: level.bandwidth)
+        if not levels:
+            logging.error('no hls level matches the level filters')
+            return levels
+        if self.mode == 'lowest':
+            levels = levels[:1]
+        elif self.mode == 'highest':
+            levels = levels[-1:]
+
+        for level in levels:
+            level.rate_limits = tuple(limit for limit in [self.rate_limit, TokenBucket.from_mbps(self.level_rate_limit)]
+                                      if limit)
+        if self.priority_level:
+            level = levels[0] if self.priority_level == 'lowest' else levels[-1]
+            level.priority = HlsLevel.PRIORITY_LEVEL
+            level.rate_limits = tuple(limit for limit in [self.rate_limit] if limit)
+        logging.info(f'selected levels: {[level.bandwidth for level in levels]}')
+        return levels
 
 
 class HlsRoot:
-    def __init__(self, args):
+    DIRECTORY = 'hls-localise-download'
+
+    def __init__(self, args, url=None, directory=None, scheduler=None):
         self.contents = None
         self.levels = []
 
-        self.url = args.urlmanifest
+        self.url = url or args.urlmanifest
         self.duration = args.duration
         self.multithreading = args.multithreading
+        self.asyncio = args.asyncio
+        self.decrypt = args.decrypt
+        self.export = args.export
+        self.resume = args.resume
+        self.verify = args.verify
+        self.index = None
+        self.selector = LevelSelector(args)
+        # a scheduler handed in by CaptureBatch is shared and outlives this root
+        self.own_scheduler = scheduler is None
+        self.scheduler = scheduler or DownloadScheduler(args.workers, args.per_host, get_cache(args))
 
-        self.directory = 'hls-localise-download'
+        self.directory = directory or args.directory or self.DIRECTORY
+        # the default directory and per job directories belong to this tool,
+        # a --directory given by the user is never deleted
+        self.own_directory = directory is not None or not args.directory
         self.manifest_name = 'root-manifest.m3u8'
         self.manifest_path = os.path.join(self.directory, self.manifest_name)
         self.localised_manifest_name = f'localised-{self.manifest_name}'
@@ -271,63 +1266,160 @@ class HlsRoot:
 
         self.download()
 
+    def prepare_directory(self):
+        if self.resume or not pathlib.Path(self.directory).is_dir():
+            return
+        if self.own_directory:
+            shutil.rmtree(self.directory)
+        elif any(os.scandir(self.directory)):
+            logging.critical(f'directory is not empty, use --resume to continue a capture in it: {self.directory}')
+            exit(1)
+
     def download(self):
-        self.contents = Downloader(self.url, filepath=self.manifest_path, delete_existing=True).text()
+        self.prepare_directory()
+        manifest = Downloader(self.url, filepath=self.manifest_path, save=False, kind='manifest')
+        if not manifest.ok:
+            logging.critical(f'cannot download manifest: {self.url}')
+            exit(1)
+        manifest.write()
+        self.contents = manifest.text()
+        self.index = DownloadIndex(self.directory, self.verify)
         # logging.debug(self.root_url)
         # logging.debug(self.root_data)
 
         # self.root_data = '#EXT-X-STREAM-INF:BANDWIDTH=1720400,CODECS="avc1.640028,mp4a.40.5",RESOLUTION=896x504,HDCP-LEVEL=NONE,SUBTITLES="subs1"'
-        pattern = "(?P<metadata>^#EXT-X-STREAM-INF.+)\n(?P<url>https://.+)"
-        level_matches = re.findall(pattern, self.contents, re.MULTILINE)
-
-        self.levels = [HlsLevel(self.directory, level[0], level[1], self.duration) for level in level_matches]
+        master = hls_parser.MasterPlaylist(self.contents, self.url)
+        levels = [HlsLevel(self.directory, variant, self.duration, self.scheduler, self.decrypt, self.index)
+                  for variant in master.variants]
+        self.levels = self.selector.select(levels)
 
+        # unselected variants are left out of the localised root manifest
+        all_levels = {level.url for level in levels}
+        localised_levels = {level.url: level.localised_manifest_path for level in self.levels}
         localised_contents = []
-        for content in self.contents.splitlines():
+        stream_inf = None
+        for content in master.lines:
+            if content.startswith('#EXT-X-STREAM-INF'):
+                stream_inf = content
+                continue
             localised = content
-            if content.startswith('https://'):
-                localised = [level.localised_manifest_path for level in self.levels if level.url == content][0]
-                localised = localised.replace(self.directory + '/', '')
+            url = hls_parser.resolve(self.url, content.strip())
+            if url in all_levels and not content.startswith('#'):
+                if url not in localised_levels:
+                    stream_inf = None
+                    continue
+                localised = os.path.relpath(localised_levels[url], self.directory)
+            if stream_inf is not None:
+                localised_contents.append(stream_inf)
+                stream_inf = None
             localised_contents.append(localised)
         with open(self.localised_manifest_path, 'w') as f:
             f.write('\n'.join(localised_contents))
 
-        if self.multithreading:
-            pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.levels))
-            [pool.submit(level.start_download) for level in self.levels]
+        if self.asyncio:
+            asyncio.run(self.start_async_download())
+        elif self.multithreading:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.levels)))
+            downloads = [pool.submit(level.start_download) for level in self.levels]
             pool.shutdown(wait=True)
+            self.report_failures([download.exception() for download in downloads])
         else:
-            # self.levels[0].start_download()
-            self.get_lowest_level().start_download()
+            # sequential, a single level unless --levels all
+            [level.start_download() for level in self.levels]
+        if self.own_scheduler:
+            self.scheduler.shutdown()
+        self.index.close()
+        if self.export:
+            [level.export(self.export) for level in self.levels]
+
+    async def start_async_download(self):
+        # one failing level must not cancel the others
+        results = await asyncio.gather(*[level.start_async_download() for level in self.levels],
+                                       return_exceptions=True)
+        self.report_failures(results)
+
+    def report_failures(self, results):
+        for level, result in zip(self.levels, results):
+            if isinstance(result, BaseException):
+                logging.error(f'{level.bandwidth} - level download failed - {result!r}')
+
+
+class CaptureBatch:
+    # every playback url found in a log becomes one capture job, jobs run on a
+    # bounded pool and share the download scheduler and its per host limits
+    JOBS = 4
+
+    def __init__(self, args):
+        self.args = args
+        self.directory = args.directory or HlsRoot.DIRECTORY
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix='capture')
+        self.scheduler = DownloadScheduler(args.workers, args.per_host, get_cache(args))
+
+    def submit(self, url):
+        with self.lock:
+            if url in self.jobs:
+                logging.debug(f'duplicate playback url - {url}')
+                return
+            job_number = len(self.jobs) + 1
+            job_id = hashlib.sha1(url.encode()).hexdigest()[:8]
+            directory = os.path.join(self.directory, f'job-{job_number:03}-{job_id}')
+            logging.info(f'capture job {job_number} - {directory} - {url}')
+            self.jobs[url] = (directory, self.pool.submit(self.capture, url, directory))
+
+    def capture(self, url, directory):
+        try:
+            HlsRoot(self.args, url, directory, self.scheduler)
+        except SystemExit:
+            raise RuntimeError(f'capture failed: {url}')
+
+    def wait(self):
+        self.pool.shutdown(wait=True)
+        self.scheduler.shutdown()
+        failed = 0
+        for url, (directory, job) in self.jobs.items():
+            if job.exception() is not None:
+                failed += 1
+                logging.error(f'capture failed: {directory} - {url} - {job.exception()}')
+        logging.info(f'captured {len(self.jobs) - failed}/{len(self.jobs)} playback urls')
 
-            # sequential all
-            # [level.start_download() for level in self.levels]
 
-    def get_lowest_level(self):
-        lowest_level = self.levels[0]
-        for level in self.levels:
-            if level.bandwidth > lowest_level.bandwidth:
-                lowest_level = level
-        return lowest_level
+def get_cache(args):
+    if not args.cache:
+        return None
+    return FragmentCache(args.cache_directory, int(args.cache_size * 1024 ** 3))
+
+
+def start_metrics(args):
+    if not args.metrics and args.metrics_port is None:
+        return
+    metrics = Metrics(args.metrics, args.metrics_port)
+    Downloader.metrics = metrics
+    RequestTimer.install()
+    atexit.register(metrics.close)
 
 
 def main(args):
     logging.debug(args)
-    logstr = None
+    HttpSession.configure(pool_size=args.pool_size, retries=args.retries)
+    start_metrics(args)
+    scanner = None
 
     if args.urlfile:
         if 'http://' in args.urlfile or 'https://' in args.urlfile:
             timestamp = datetime.datetime.now().isoformat()
             logfile = f'wpe-{timestamp}.log'
             logfile = os.path.join('logs', logfile)
-            logstr = Downloader(args.urlfile, filepath=logfile).text()
+            scanner = LogScanner(args.urlfile, follow=args.follow, logfile=logfile)
         else:
             logging.critical(f'cannot find urlfile: {args.urlfile}')
             exit(1)
     elif args.localfile:
         if os.path.isfile(args.localfile):
-            with open(args.localfile, 'r') as f:
-                logstr = f.read()
+            if args.follow and args.mmap:
+                logging.warning('--mmap is ignored with --follow, a growing log is read with buffered reads')
+            scanner = LogScanner(args.localfile, follow=args.follow, use_mmap=args.mmap)
         else:
             logging.critical(f'cannot find localfile: {args.localfile}')
             exit(1)
@@ -337,24 +1429,30 @@ def main(args):
     elif args.locallevelmanifest:
         raw = '#EXT-X-STREAM-INF:BANDWIDTH=1720400,CODECS="avc1.640028,mp4a.40.5",RESOLUTION=896x504,HDCP-LEVEL=NONE,SUBTITLES="subs1"'
         directory = args.directory
-        level = HlsLevel(directory, raw, None, None)
+        scheduler = DownloadScheduler(args.workers, args.per_host, get_cache(args))
+        index = DownloadIndex(directory, args.verify)
+        level = HlsLevel(directory, hls_parser.Variant(raw), None, scheduler, args.decrypt, index)
         level.precached_level = args.locallevelmanifest
+        level.rate_limits = tuple(limit for limit in [TokenBucket.from_mbps(args.rate_limit)] if limit)
         level.start_precached_download()
+        scheduler.shutdown()
+        index.close()
+        if args.export:
+            level.export(args.export)
         exit()
     else:
         logging.error(f'no input logfile was supplied')
+        exit(1)
 
-    uptime = Uptime()
-    for line in logstr.splitlines():
-        uptime.find_and_update(line)
-        if 'setPlaybackInformation' in line:
-            # track = VideoTrack(line)
-            # print(track.to_string())
-            pattern = "({.*})"
-            playback_info = json.loads(Matcher.find_once(pattern, line))
-            url = playback_info['url']
-            HlsRoot(url, args.time)
-    print(f'uptime: {uptime.uptime}')
+    # captures start as soon as their playback line is read, with --follow
+    # the log is tailed until interrupted
+    batch = CaptureBatch(args)
+    try:
+        scanner.scan(batch.submit)
+    except KeyboardInterrupt:
+        logging.info('stopped following log, waiting for running captures')
+    batch.wait()
+    print(f'uptime: {scanner.uptime.uptime}')
 
 
 logging.basicConfig(level=logging.INFO)
@@ -380,17 +1478,104 @@ parser.add_argument('-m', "--urlmanifest",
 parser.add_argument('--multithreading',
                     help='enable multithreading to download all hls levels',
                     action='store_true')
+parser.add_argument('--asyncio',
+                    help='poll and download all hls levels as coroutines on a single event loop',
+                    action='store_true')
+parser.add_argument('--decrypt',
+                    help='decrypt AES-128 fragments while downloading and write a METHOD=NONE localised manifest',
+                    action='store_true')
+parser.add_argument('--export',
+                    help='join each captured level into a single export-level-*.ts or .mp4 when the capture ends',
+                    choices=['ts', 'mp4'])
+parser.add_argument('--resume',
+                    help='keep the existing download directory and only fetch what is missing or truncated',
+                    action='store_true')
+parser.add_argument('--verify',
+                    help='check the sha256 of already downloaded files before skipping them',
+                    action='store_true')
+parser.add_argument('--cache',
+                    help='link fragments from a content addressed cache shared across levels and runs, hits are '
+                         'revalidated against the stored ETag, urls without one are assumed immutable, '
+                         'keys are shared in memory by the key cache',
+                    action='store_true')
+parser.add_argument('--cache-directory',
+                    help='directory of the fragment cache',
+                    default=FragmentCache.DIRECTORY)
+parser.add_argument('--cache-size',
+                    help='size of the fragment cache in GiB, least recently used fragments are evicted first',
+                    default=FragmentCache.MAX_SIZE / 1024 ** 3,
+                    type=float)
+parser.add_argument('--levels',
+                    help='hls levels to download after filtering, default lowest, or all with multithreading/asyncio',
+                    choices=['lowest', 'highest', 'all'])
+parser.add_argument('--min-bandwidth',
+                    help='skip levels below this BANDWIDTH in bits per second',
+                    type=int)
+parser.add_argument('--max-bandwidth',
+                    help='skip levels above this BANDWIDTH in bits per second',
+                    type=int)
+parser.add_argument('--min-height',
+                    help='skip levels below this vertical resolution, eg 720',
+                    type=int)
+parser.add_argument('--max-height',
+                    help='skip levels above this vertical resolution, eg 1080',
+                    type=int)
+parser.add_argument('--codecs',
+                    help='only levels with these codec prefixes, eg avc1 or hvc1,mp4a',
+                    nargs='?')
+parser.add_argument('--rate-limit',
+                    help='total download rate in Mbit/s across all levels',
+                    type=float)
+parser.add_argument('--level-rate-limit',
+                    help='download rate in Mbit/s for each level, the priority level is exempt',
+                    type=float)
+parser.add_argument('--priority-level',
+                    help='level whose playlists and fragments are fetched ahead of the others',
+                    choices=['lowest', 'highest'])
+parser.add_argument('--jobs',
+                    help='playback urls from a log captured at the same time',
+                    default=CaptureBatch.JOBS,
+                    type=int)
+parser.add_argument('--pool-size',
+                    help='maximum keep-alive connections kept per host',
+                    default=HttpSession.POOL_SIZE,
+                    type=int)
+parser.add_argument('--retries',
+                    help='retries with backoff on 5xx responses and connection resets',
+                    default=HttpSession.RETRIES,
+                    type=int)
+parser.add_argument('--workers',
+                    help='fragment and key downloads running in parallel across all levels',
+                    default=DownloadScheduler.WORKERS,
+                    type=int)
+parser.add_argument('--per-host',
+                    help='maximum parallel downloads from a single host',
+                    default=DownloadScheduler.PER_HOST,
+                    type=int)
+parser.add_argument('--metrics',
+                    help='append per request timings to this jsonl file',
+                    metavar='FILE')
+parser.add_argument('--metrics-port',
+                    help='serve prometheus metrics on http://127.0.0.1:PORT/metrics',
+                    metavar='PORT',
+                    type=int)
 parser.add_argument('-l', "--localfile",
                     help='local path to logfile, eg ./wpe_exe_log.txt',
                     nargs='?')
+parser.add_argument('-f', '--follow',
+                    help='keep reading the log as it grows and start captures for new playback lines',
+                    action='store_true')
+parser.add_argument('--mmap',
+                    help='memory map a local log instead of buffered reads, not used with --follow',
+                    action='store_true')
 parser.add_argument("--locallevelmanifest",
                     help='local path to level manifest, eg ./720p.m3u8',
                     nargs='?')
 parser.add_argument("--directory",
-                    help='output directory to save the download',
+                    help='output directory to save the download, must be empty or used with --resume',
                     nargs='?')
 parser.add_argument('-t', "--duration",
-                    help='time in seconds to download',
+                    help='time in seconds to download, the playlist is reloaded every target duration',
                     default=1,
                     type=int,
                     nargs='?')
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import errno
+import shutil
+import sqlite3
+import logging
+import pathlib
+import threading
+import datetime
+
+# content addressed fragment cache shared by every capture on the host, blobs
+# are stored once per sha256 under objects/ and linked into capture
+# directories, urls map onto blobs through a small sqlite index
+
+FICLONE = 0x40049409
+
+
+def reflink(source, destination):
+    import fcntl
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def link_or_copy(source, destination):
+    # hardlink when on the same filesystem, otherwise try a reflink and fall
+    # back to a plain copy
+    try:
+        os.link(source, destination)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    try:
+        reflink(source, destination)
+        return
+    except (OSError, ImportError):
+        pathlib.Path(destination).unlink(missing_ok=True)
+    shutil.copyfile(source, destination)
+
+
+class FragmentCache:
+    DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'hls-localise')
+    MAX_SIZE = 10 * 1024 ** 3
+    PARTIAL_SUFFIX = '.part'
+
+    def __init__(self, directory=DIRECTORY, max_size=MAX_SIZE):
+        self.directory = pathlib.Path(directory)
+        self.objects = self.directory.joinpath('objects')
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.directory.joinpath('index.sqlite3'), timeout=30,
+                                          check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                                    '(key TEXT PRIMARY KEY, url TEXT, etag TEXT, sha256 TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS blobs '
+                                    '(sha256 TEXT PRIMARY KEY, size INTEGER, last_access REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)')
+
+    def get_blob_path(self, sha256):
+        return self.objects.joinpath(sha256[:2], sha256)
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT blobs.sha256, blobs.size FROM entries '
+                                          'JOIN blobs ON blobs.sha256 = entries.sha256 WHERE entries.key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE blobs SET last_access = ? WHERE sha256 = ?',
+                                    (datetime.datetime.now().timestamp(), row[0]))
+        return row
+
+    def get_etag(self, key):
+        # None when the key is not cached, '' when it was stored without one
+        with self.lock:
+            row = self.connection.execute('SELECT etag FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0] or ''
+
+    def link(self, key, destination):
+        # returns (sha256, size) when the destination was linked from the cache
+        row = self.lookup(key)
+        if row is None:
+            return None
+        sha256, size = row
+        blob_path = self.get_blob_path(sha256)
+        if not blob_path.is_file() or blob_path.stat().st_size != size:
+            logging.warning(f'cache blob missing or damaged - {blob_path}')
+            self.forget(sha256)
+            return None
+        partial_path = f'{destination}{self.PARTIAL_SUFFIX}'
+        pathlib.Path(destination).parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(partial_path).unlink(missing_ok=True)
+        link_or_copy(blob_path, partial_path)
+        os.replace(partial_path, destination)
+        logging.debug(f'cache hit - {destination} - {sha256}')
+        return sha256, size
+
+    def store(self, key, url, etag, source, sha256, size):
+        blob_path = self.get_blob_path(sha256)
+        if not blob_path.is_file():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            partial_path = f'{blob_path}.{threading.get_ident()}{self.PARTIAL_SUFFIX}'
+            link_or_copy(source, partial_path)
+            os.replace(partial_path, blob_path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                                    (sha256, size, datetime.datetime.now().timestamp()))
+            self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, url, etag, sha256))
+        self.evict()
+
+    def forget(self, sha256):
+        with self.lock:
+            self.connection.execute('DELETE FROM entries WHERE sha256 = ?', (sha256,))
+            self.connection.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+
+    def evict(self):
+        # least recently used blobs go first, captures keep their own hardlinks
+        with self.lock:
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total <= self.max_size:
+                return
+            rows = self.connection.execute('SELECT sha256, size FROM blobs ORDER BY last_access').fetchall()
+        for sha256, size in rows:
+            if total <= self.max_size:
+                break
+            self.get_blob_path(sha256).unlink(missing_ok=True)
+            self.forget(sha256)
+            total -= size
+            logging.debug(f'cache evicted - {sha256}')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
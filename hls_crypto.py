@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import threading
+import concurrent.futures
+from time import monotonic
+from Crypto.Cipher import AES
+
+# AES-128 CBC decryption for HLS fragments, ciphertext is decrypted through a
+# fixed size buffer so a fragment is never held in memory as a whole
+
+BLOCK_SIZE = AES.block_size
+BUFFER_SIZE = 256 * 1024
+
+
+def strip_padding(data, name=None):
+    # PKCS7, the value of the last byte is the number of padding bytes
+    if not data:
+        return data
+    padding = data[-1]
+    if 1 <= padding <= BLOCK_SIZE and len(data) >= padding and data[-padding:] == bytes([padding]) * padding:
+        return data[:-padding]
+    logging.warning(f'invalid pkcs7 padding, leaving data untouched: {name}')
+    return data
+
+
+class Aes128Decryptor:
+    # incremental decryption for data arriving in arbitrary sized chunks, the
+    # last whole block is held back until finalize() so padding can be stripped
+    def __init__(self, key, iv, name=None):
+        self.cipher = AES.new(key, AES.MODE_CBC, iv=iv)
+        self.pending = b''
+        self.name = name
+
+    def update(self, data):
+        if self.pending:
+            data = self.pending + data
+        length = len(data) - len(data) % BLOCK_SIZE
+        if length == len(data):
+            length -= BLOCK_SIZE
+        if length <= 0:
+            self.pending = data
+            return b''
+        self.pending = data[length:]
+        return self.cipher.decrypt(memoryview(data)[:length])
+
+    def finalize(self):
+        if len(self.pending) % BLOCK_SIZE:
+            logging.warning(f'ciphertext is not a multiple of the block size: {self.name}')
+            self.pending = self.pending[:len(self.pending) - len(self.pending) % BLOCK_SIZE]
+        data = self.cipher.decrypt(self.pending) if self.pending else b''
+        self.pending = b''
+        return strip_padding(data, self.name)
+
+
+class KeyCache:
+    # key bytes by uri for the whole process, every caller asking for a uri
+    # that is being fetched waits on the same future, fetched keys are
+    # served from memory until they are TTL seconds old
+    TTL = 600
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # uri -> [future, expiry], expiry is None while the fetch runs
+        self.entries = {}
+
+    def get_future(self, uri, start):
+        # start(future) begins a fetch that resolves the future, it is only
+        # called when the uri is neither cached nor already being fetched
+        with self.lock:
+            entry = self.entries.get(uri)
+            if entry is not None and (entry[1] is None or monotonic() < entry[1]):
+                return entry[0]
+            future = concurrent.futures.Future()
+            self.entries[uri] = [future, None]
+        future.add_done_callback(lambda future: self.settle(uri, future))
+        start(future)
+        return future
+
+    def get(self, uri, fetch):
+        # blocking lookup, fetch() returns the key bytes
+        return self.get_future(uri, lambda future: self.resolve(future, fetch)).result()
+
+    def resolve(self, future, fetch):
+        try:
+            future.set_result(fetch())
+        except Exception as e:
+            future.set_exception(e)
+
+    def settle(self, uri, future):
+        # failures are not cached, the next caller tries again
+        with self.lock:
+            entry = self.entries.get(uri)
+            if entry is None or entry[0] is not future:
+                return
+            if future.exception() is not None:
+                del self.entries[uri]
+            else:
+                entry[1] = monotonic() + self.ttl
+
+
+KEYS = KeyCache()
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_keys(playlist, parent_path):
+    # keys are read once per uri, relative to the localised manifest
+    encryption_keys = {}
+    for segment in playlist.segments:
+        key = segment.key
+        if key is None or key.method != 'AES-128' or key.uri in encryption_keys:
+            continue
+        key_path = parent_path.joinpath(key.uri)
+        encryption_keys[key.uri] = KEYS.get(str(key_path), lambda: read_file(key_path))
+    return encryption_keys
+
+
+def decrypt_file(encrypted_filepath, decrypted_filepath, key, iv, buffer_size=BUFFER_SIZE):
+    with open(encrypted_filepath, 'rb') as fin, open(decrypted_filepath, 'wb') as fout:
+        decrypt_stream(fin, fout, key, iv, buffer_size, encrypted_filepath)
+
+
+def decrypt_stream(fin, fout, key, iv, buffer_size=BUFFER_SIZE, name=None):
+    # readinto a preallocated buffer and decrypt into a second one, the file
+    # size tells us which read is the last so only that one is unpadded
+    buffer_size -= buffer_size % BLOCK_SIZE
+    cipher = AES.new(key, AES.MODE_CBC, iv=iv)
+    encrypted = bytearray(buffer_size)
+    decrypted = bytearray(buffer_size)
+    encrypted_view = memoryview(encrypted)
+    decrypted_view = memoryview(decrypted)
+
+    remaining = os.fstat(fin.fileno()).st_size - fin.tell()
+    if remaining % BLOCK_SIZE:
+        logging.warning(f'ciphertext is not a multiple of the block size: {name}')
+        remaining -= remaining % BLOCK_SIZE
+    while remaining > 0:
+        length = fin.readinto(encrypted_view[:min(buffer_size, remaining)])
+        if not length:
+            break
+        remaining -= length
+        cipher.decrypt(encrypted_view[:length], output=decrypted_view[:length])
+        if remaining > 0:
+            fout.write(decrypted_view[:length])
+        else:
+            fout.write(strip_padding(decrypted_view[:length], name))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import errno
+import shutil
+import pathlib
+import logging
+import subprocess
+from argparse import ArgumentParser
+from hls_parser import MediaPlaylist
+import hls_crypto
+
+# joins the fragments of a localised level manifest into one stream, clear
+# fragments are copied by the kernel, encrypted ones are decrypted on the way
+# through, an .mp4 output is remuxed by ffmpeg reading the joined ts on a pipe
+
+PARTIAL_SUFFIX = '.part'
+FALLBACK_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+REMUX_COMMAND = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'mpegts', '-i', 'pipe:0', '-map', '0',
+                 '-c', 'copy', '-movflags', '+frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', '-y']
+
+
+def copy_file_range(source, destination, count):
+    return os.copy_file_range(source, destination, count)
+
+
+def sendfile(source, destination, count):
+    return os.sendfile(destination, source, None, count)
+
+
+def copy_range(fin, fout, count):
+    # copy_file_range between files, sendfile when the output is a pipe or
+    # the kernel refuses, both move the file positions so a plain copy can
+    # carry on from wherever they stopped
+    fout.flush()
+    source = fin.fileno()
+    destination = fout.fileno()
+    for copy in (copy_file_range, sendfile):
+        try:
+            while count > 0:
+                copied = copy(source, destination, count)
+                if not copied:
+                    break
+                count -= copied
+            return
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+    shutil.copyfileobj(fin, fout)
+
+
+def export_fragments(manifest_path, fout, decrypt=True):
+    parent_path = pathlib.Path(manifest_path).parent
+    with open(manifest_path) as f:
+        playlist = MediaPlaylist(f.read())
+    encryption_keys = hls_crypto.read_keys(playlist, parent_path) if decrypt else {}
+
+    exported = 0
+    size = 0
+    for segment in playlist.segments:
+        fragment_path = parent_path.joinpath(segment.uri)
+        if not fragment_path.is_file():
+            logging.warning(f'missing fragment, skipped - {fragment_path}')
+            continue
+        key = segment.key
+        with open(fragment_path, 'rb') as fin:
+            if key is not None and key.method == 'AES-128' and decrypt:
+                hls_crypto.decrypt_stream(fin, fout, encryption_keys[key.uri], key.get_iv(segment.sequence),
+                                          name=fragment_path)
+            else:
+                if key is not None and key.is_encrypted():
+                    logging.warning(f'{key.method} fragment exported encrypted - {fragment_path}')
+                copy_range(fin, fout, os.fstat(fin.fileno()).st_size)
+        if segment.discontinuity:
+            logging.debug(f'discontinuity before {fragment_path}')
+        exported += 1
+        size += fragment_path.stat().st_size
+    fout.flush()
+    logging.info(f'exported {exported}/{len(playlist.segments)} fragments, {size / 1024 / 1024:.1f} MiB - {manifest_path}')
+    return exported
+
+
+def export(manifest_path, output, decrypt=True):
+    if pathlib.Path(output).suffix == '.mp4':
+        return remux(manifest_path, output, decrypt)
+    pathlib.Path(output).parent.mkdir(parents=True, exist_ok=True)
+    partial_path = f'{output}{PARTIAL_SUFFIX}'
+    try:
+        with open(partial_path, 'wb') as fout:
+            exported = export_fragments(manifest_path, fout, decrypt)
+        os.replace(partial_path, output)
+    finally:
+        pathlib.Path(partial_path).unlink(missing_ok=True)
+    return exported
+
+
+def remux(manifest_path, output, decrypt=True):
+    if shutil.which(REMUX_COMMAND[0]) is None:
+        logging.error(f'{REMUX_COMMAND[0]} not found, cannot remux to mp4 - {output}')
+        return 0
+    pathlib.Path(output).parent.mkdir(parents=True, exist_ok=True)
+    partial_path = f'{output}{PARTIAL_SUFFIX}'
+    try:
+        process = subprocess.Popen(REMUX_COMMAND + [partial_path], stdin=subprocess.PIPE)
+        try:
+            exported = export_fragments(manifest_path, process.stdin, decrypt)
+        finally:
+            process.stdin.close()
+            process.wait()
+        if process.returncode:
+            logging.error(f'remux failed with {process.returncode} - {output}')
+            return 0
+        os.replace(partial_path, output)
+    finally:
+        pathlib.Path(partial_path).unlink(missing_ok=True)
+    return exported
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = ArgumentParser()
+    parser.description = 'Join the fragments of a localised level manifest into a single ts or mp4'
+    parser.add_argument('manifest',
+                        help='localised level manifest, eg ./localised-level-00950400-0288p.m3u8')
+    parser.add_argument('output',
+                        help='output file, .mp4 is remuxed with ffmpeg, anything else is written as ts')
+    parser.add_argument('--no-decrypt',
+                        help='keep AES-128 fragments encrypted',
+                        dest='decrypt',
+                        action='store_false')
+    parser.add_argument("-d", "--debug",
+                        help="Enable debug",
+                        action="store_const",
+                        dest='loglevel',
+                        const=logging.DEBUG,
+                        default=logging.INFO)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.loglevel)
+    if not export(args.manifest, args.output, args.decrypt):
+        exit(1)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# per request timings of the localiser, appended to a jsonl file, exposed in
+# prometheus text format on a local port and summarised at exit
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Metrics:
+    TIMINGS = ['dns', 'connect', 'tls', 'ttfb', 'write', 'total']
+
+    def __init__(self, path=None, port=None):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a') if path else None
+        self.requests = {}
+        self.lags = {}
+        self.server = None
+        if port:
+            self.serve(port)
+
+    def record_request(self, kind, url, filepath, status, size, timings, reused, level=None):
+        total = timings.get('total', 0)
+        record = {
+            'time': datetime.datetime.now().isoformat(),
+            'kind': kind,
+            'level': level,
+            'url': url,
+            'path': str(filepath),
+            'status': status,
+            'bytes': size,
+            'reused': reused,
+            'throughput': size / total if total else None,
+        }
+        record.update({name: round(timings.get(name, 0), 6) for name in self.TIMINGS})
+        with self.lock:
+            stats = self.requests.setdefault(kind, {'count': 0, 'failures': 0, 'bytes': 0, 'reused': 0,
+                                                    'sums': dict.fromkeys(self.TIMINGS, 0), 'totals': []})
+            stats['count'] += 1
+            stats['failures'] += status is None or status >= 400
+            stats['bytes'] += size
+            stats['reused'] += reused
+            for name in self.TIMINGS:
+                stats['sums'][name] += timings.get(name, 0)
+            stats['totals'].append(total)
+            self.write(record)
+
+    def record_lag(self, level, lag):
+        # seconds between the end of the newest segment, by its
+        # EXT-X-PROGRAM-DATE-TIME, and the moment it was on disk
+        with self.lock:
+            lags = self.lags.setdefault(level, [])
+            lags.append(lag)
+            self.write({'time': datetime.datetime.now().isoformat(), 'kind': 'lag', 'level': level,
+                        'lag': round(lag, 3)})
+
+    def write(self, record):
+        if self.file:
+            self.file.write(json.dumps(record) + '\n')
+
+    def render(self):
+        lines = ['# TYPE hls_requests_total counter', '# TYPE hls_request_failures_total counter',
+                 '# TYPE hls_bytes_total counter', '# TYPE hls_connections_reused_total counter',
+                 '# TYPE hls_request_seconds_sum counter', '# TYPE hls_live_lag_seconds gauge']
+        with self.lock:
+            for kind, stats in self.requests.items():
+                lines.append(f'hls_requests_total{{kind="{kind}"}} {stats["count"]}')
+                lines.append(f'hls_request_failures_total{{kind="{kind}"}} {stats["failures"]}')
+                lines.append(f'hls_bytes_total{{kind="{kind}"}} {stats["bytes"]}')
+                lines.append(f'hls_connections_reused_total{{kind="{kind}"}} {stats["reused"]}')
+                for name in self.TIMINGS:
+                    lines.append(f'hls_request_seconds_sum{{kind="{kind}",phase="{name}"}} {stats["sums"][name]:.6f}')
+            for level, lags in self.lags.items():
+                lines.append(f'hls_live_lag_seconds{{level="{level}"}} {lags[-1]:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f'metrics - {format % args}')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        logging.info(f'metrics on http://127.0.0.1:{self.server.server_port}/metrics')
+
+    def summary(self):
+        with self.lock:
+            for kind, stats in sorted(self.requests.items()):
+                seconds = stats['sums']['total']
+                throughput = stats['bytes'] * 8 / seconds / 1000 / 1000 if seconds else 0
+                logging.info(f'metrics {kind}: {stats["count"]} requests, {stats["failures"]} failed, '
+                             f'{stats["bytes"] / 1024 / 1024:.1f} MiB, {throughput:.1f} Mbit/s, '
+                             f'{stats["reused"]} reused connections, '
+                             f'p50 {percentile(stats["totals"], 0.5):.3f}s p95 {percentile(stats["totals"], 0.95):.3f}s, '
+                             f'connect {stats["sums"]["connect"]:.1f}s tls {stats["sums"]["tls"]:.1f}s '
+                             f'write {stats["sums"]["write"]:.1f}s')
+            for level, lags in sorted(self.lags.items()):
+                logging.info(f'metrics lag {level}: last {lags[-1]:.1f}s, p50 {percentile(lags, 0.5):.1f}s, '
+                             f'max {max(lags):.1f}s')
+
+    def close(self):
+        self.summary()
+        if self.server:
+            self.server.shutdown()
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import re
+from urllib.parse import urljoin
+
+# single pass m3u8 tokeniser shared by hls-localise.py and decrypt_fragments.py
+# every line is split once on ':' and dispatched on the tag name, attribute
+# lists go through one precompiled pattern
+
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+RESOLUTION_PATTERN = re.compile(r'([0-9]+)x([0-9]+)')
+
+NO_TAGS = ()
+ABSOLUTE_PREFIXES = ('https://', 'http://')
+
+
+def parse_attributes(value):
+    attributes = {}
+    for name, attribute in ATTRIBUTE_PATTERN.findall(value):
+        if attribute.startswith('"'):
+            attribute = attribute[1:-1]
+        attributes[name] = attribute
+    return attributes
+
+
+def parse_int(value, default=None):
+    # some packagers write decimal values like TARGETDURATION:6.0
+    try:
+        return int(float(value))
+    except ValueError:
+        return default
+
+
+def resolve(url, uri):
+    if url is None or uri is None or uri.startswith(ABSOLUTE_PREFIXES):
+        return uri
+    return urljoin(url, uri)
+
+
+class Resolver:
+    # urljoin dominates parse time on long playlists, plain relative names
+    # like 'segment-1.ts' are joined onto the playlist directory directly
+    __slots__ = ('url', 'base')
+
+    def __init__(self, url):
+        self.url = url
+        self.base = None
+        if url is not None and '?' not in url and '#' not in url:
+            self.base = url[:url.rfind('/') + 1]
+
+    def resolve(self, uri):
+        if self.url is None or uri.startswith(ABSOLUTE_PREFIXES):
+            return uri
+        if self.base and uri[0] not in './?#' and ':' not in uri and '/.' not in uri:
+            return self.base + uri
+        return urljoin(self.url, uri)
+
+
+class Key:
+    __slots__ = ('line', 'method', 'uri', 'url', 'iv', 'keyformat', 'keyformatversions')
+
+    def __init__(self, line, url=None):
+        attributes = parse_attributes(line.partition(':')[2])
+        self.line = line
+        self.method = attributes.get('METHOD', 'NONE')
+        self.uri = attributes.get('URI')
+        self.url = resolve(url, self.uri)
+        self.iv = None
+        iv = attributes.get('IV')
+        if iv:
+            self.iv = bytes.fromhex(iv[2:] if iv[:2] in ('0x', '0X') else iv)
+        self.keyformat = attributes.get('KEYFORMAT')
+        self.keyformatversions = attributes.get('KEYFORMATVERSIONS')
+
+    def is_encrypted(self):
+        return self.method != 'NONE'
+
+    def get_iv(self, sequence):
+        # RFC 8216 5.2: without an IV attribute the media sequence number is
+        # the IV, as a big endian 128 bit integer
+        if self.iv is not None:
+            return self.iv
+        return sequence.to_bytes(16, 'big')
+
+    def localise(self, uri):
+        return self.line.replace(f'URI="{self.uri}"', f'URI="{uri}"')
+
+
+class Segment:
+    __slots__ = ('sequence', 'uri', 'duration', 'extinf', 'key', 'discontinuity', 'program_date_time', 'tags')
+
+    def __init__(self, sequence, uri, duration, extinf, key, discontinuity, program_date_time, tags):
+        self.sequence = sequence
+        self.uri = uri
+        self.duration = duration
+        self.extinf = extinf
+        self.key = key
+        self.discontinuity = discontinuity
+        self.program_date_time = program_date_time
+        self.tags = tags
+
+
+class Variant:
+    __slots__ = ('line', 'uri', 'bandwidth', 'average_bandwidth', 'codecs', 'width', 'height', 'frame_rate',
+                 'hdcp_level', 'subtitles', 'audio')
+
+    def __init__(self, line, uri=None):
+        attributes = parse_attributes(line.partition(':')[2])
+        self.line = line
+        self.uri = uri
+        self.bandwidth = int(attributes.get('BANDWIDTH', 0))
+        self.average_bandwidth = int(attributes['AVERAGE-BANDWIDTH']) if 'AVERAGE-BANDWIDTH' in attributes else None
+        self.codecs = attributes.get('CODECS')
+        self.width = 0
+        self.height = 0
+        resolution = RESOLUTION_PATTERN.match(attributes.get('RESOLUTION', ''))
+        if resolution:
+            self.width = int(resolution.group(1))
+            self.height = int(resolution.group(2))
+        self.frame_rate = float(attributes['FRAME-RATE']) if 'FRAME-RATE' in attributes else None
+        self.hdcp_level = attributes.get('HDCP-LEVEL')
+        self.subtitles = attributes.get('SUBTITLES')
+        self.audio = attributes.get('AUDIO')
+
+
+class MasterPlaylist:
+    __slots__ = ('url', 'lines', 'variants')
+
+    def __init__(self, contents, url=None):
+        self.url = url
+        self.lines = contents.splitlines()
+        self.variants = []
+        self.parse()
+
+    def parse(self):
+        stream_inf = None
+        for line in self.lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXT-X-STREAM-INF:'):
+                stream_inf = line
+            elif stream_inf is not None and not line.startswith('#'):
+                self.variants.append(Variant(stream_inf, resolve(self.url, line)))
+                stream_inf = None
+
+
+class MediaPlaylist:
+    # segments are keyed by media sequence number, only the ones after
+    # `after` are turned into Segment records, earlier lines just advance
+    # the sequence counter and the key in force
+    __slots__ = ('url', 'header', 'version', 'target_duration', 'media_sequence', 'discontinuity_sequence',
+                 'playlist_type', 'endlist', 'segments', 'last_sequence')
+
+    HEADER_TAGS = frozenset(['#EXTM3U', '#EXT-X-VERSION', '#EXT-X-TARGETDURATION', '#EXT-X-MEDIA-SEQUENCE',
+                             '#EXT-X-DISCONTINUITY-SEQUENCE', '#EXT-X-PLAYLIST-TYPE', '#EXT-X-INDEPENDENT-SEGMENTS'])
+
+    def __init__(self, contents, url=None, after=None):
+        self.url = url
+        self.header = []
+        self.version = None
+        self.target_duration = None
+        self.media_sequence = 0
+        self.discontinuity_sequence = 0
+        self.playlist_type = None
+        self.endlist = False
+        self.segments = []
+        self.last_sequence = None
+        self.parse(contents, after)
+
+    def parse(self, contents, after):
+        url = self.url
+        resolver = Resolver(url)
+        header_tags = self.HEADER_TAGS
+        segments = self.segments
+        keys = {}
+
+        sequence = None
+        key = None
+        extinf = None
+        discontinuity = False
+        program_date_time = None
+        tags = NO_TAGS
+        for line in contents.splitlines():
+            if not line:
+                continue
+            if line[0] != '#':
+                if sequence is None:
+                    sequence = self.media_sequence
+                if after is None or sequence > after:
+                    duration = float(extinf[8:].partition(',')[0]) if extinf else None
+                    segments.append(Segment(sequence, resolver.resolve(line.strip()), duration, extinf, key,
+                                            discontinuity, program_date_time, tags))
+                self.last_sequence = sequence
+                sequence += 1
+                extinf = None
+                discontinuity = False
+                program_date_time = None
+                tags = NO_TAGS
+                continue
+
+            line = line.rstrip()
+            tag, _, value = line.partition(':')
+            if tag == '#EXTINF':
+                extinf = line
+            elif tag == '#EXT-X-KEY':
+                key = keys.get(line)
+                if key is None:
+                    key = keys[line] = Key(line, url)
+            elif tag == '#EXT-X-PROGRAM-DATE-TIME':
+                program_date_time = line
+            elif tag == '#EXT-X-DISCONTINUITY':
+                discontinuity = True
+            elif tag == '#EXT-X-ENDLIST':
+                self.endlist = True
+            elif sequence is None and tag in header_tags:
+                self.header.append(line)
+                if tag == '#EXT-X-VERSION':
+                    self.version = parse_int(value)
+                elif tag == '#EXT-X-TARGETDURATION':
+                    self.target_duration = parse_int(value)
+                elif tag == '#EXT-X-MEDIA-SEQUENCE':
+                    self.media_sequence = parse_int(value, 0)
+                elif tag == '#EXT-X-DISCONTINUITY-SEQUENCE':
+                    self.discontinuity_sequence = parse_int(value, 0)
+                elif tag == '#EXT-X-PLAYLIST-TYPE':
+                    self.playlist_type = value
+            else:
+                tags = tags + (line,)
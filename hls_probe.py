@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import pathlib
+import logging
+import concurrent.futures
+from argparse import ArgumentParser
+from hls_parser import MediaPlaylist
+
+# mpeg-ts probing without decoding: the PAT and PMT give the elementary
+# streams and their codecs, PES headers give the PTS range, and every packet
+# header is checked for continuity counter gaps and discontinuity indicators
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+NULL_PID = 0x1fff
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+# ISO/IEC 13818-1 table 2-34, plus the ATSC and SAMPLE-AES types seen in hls
+STREAM_TYPES = {
+    0x01: 'mpeg1video',
+    0x02: 'mpeg2video',
+    0x03: 'mp3',
+    0x04: 'mp3',
+    0x0f: 'aac',
+    0x11: 'aac-latm',
+    0x15: 'id3',
+    0x1b: 'h264',
+    0x24: 'hevc',
+    0x81: 'ac3',
+    0x86: 'scte35',
+    0x87: 'eac3',
+    0xcf: 'aac-sample-aes',
+    0xdb: 'h264-sample-aes',
+    0xc1: 'ac3-sample-aes',
+    0xc2: 'eac3-sample-aes',
+}
+
+# descriptors that name the codec of stream_type 0x06 private data
+DESCRIPTOR_CODECS = {
+    0x56: 'teletext',
+    0x59: 'dvbsub',
+    0x6a: 'ac3',
+    0x7a: 'eac3',
+    0x7b: 'dts',
+}
+
+VIDEO_CODECS = frozenset(['mpeg1video', 'mpeg2video', 'h264', 'hevc', 'h264-sample-aes'])
+
+DIGITS_PATTERN = re.compile(r'([0-9]+)')
+
+
+class Stream:
+    __slots__ = ('pid', 'stream_type', 'codec', 'pes', 'first_pts', 'last_pts', 'min_pts', 'max_pts')
+
+    def __init__(self, pid, stream_type, codec):
+        self.pid = pid
+        self.stream_type = stream_type
+        self.codec = codec
+        self.pes = 0
+        self.first_pts = None
+        self.last_pts = None
+        self.min_pts = None
+        self.max_pts = None
+
+    def add_pts(self, pts):
+        if self.first_pts is None:
+            self.first_pts = self.min_pts = self.max_pts = pts
+        else:
+            # unwrap against the first pts so a 33 bit rollover inside a
+            # fragment still gives a positive duration
+            if pts < self.first_pts - PTS_WRAP // 2:
+                pts += PTS_WRAP
+            self.min_pts = min(self.min_pts, pts)
+            self.max_pts = max(self.max_pts, pts)
+        self.last_pts = pts
+
+    def get_duration(self):
+        if self.min_pts is None:
+            return 0
+        return (self.max_pts - self.min_pts) / PTS_CLOCK
+
+    def to_dict(self):
+        return {'pid': self.pid, 'stream_type': self.stream_type, 'codec': self.codec, 'pes': self.pes,
+                'first_pts': self.first_pts, 'last_pts': self.last_pts, 'min_pts': self.min_pts,
+                'max_pts': self.max_pts}
+
+
+class Probe:
+    __slots__ = ('path', 'size', 'packets', 'sync_errors', 'pmt_pids', 'streams', 'continuity_errors',
+                 'discontinuities', 'scrambled')
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.size = 0
+        self.packets = 0
+        self.sync_errors = 0
+        self.pmt_pids = set()
+        self.streams = {}
+        self.continuity_errors = 0
+        self.discontinuities = 0
+        self.scrambled = 0
+
+    def get_main_stream(self):
+        # video when there is any, otherwise the first stream with timestamps
+        streams = [stream for stream in self.streams.values() if stream.min_pts is not None]
+        for stream in streams:
+            if stream.codec in VIDEO_CODECS:
+                return stream
+        return streams[0] if streams else None
+
+    def get_codecs(self):
+        return ','.join(f'{stream.codec}@{stream.pid:#x}' for stream in self.streams.values())
+
+    def is_valid(self):
+        return self.packets > 0 and self.sync_errors == 0 and bool(self.streams)
+
+    def to_dict(self):
+        return {'path': self.path, 'size': self.size, 'packets': self.packets, 'sync_errors': self.sync_errors,
+                'continuity_errors': self.continuity_errors, 'discontinuities': self.discontinuities,
+                'scrambled': self.scrambled, 'streams': [stream.to_dict() for stream in self.streams.values()]}
+
+
+def parse_pts(data, offset):
+    return ((data[offset] >> 1 & 0x07) << 30 | data[offset + 1] << 22 | (data[offset + 2] >> 1) << 15 |
+            data[offset + 3] << 7 | data[offset + 4] >> 1)
+
+
+def get_section(packet, start):
+    # pointer_field then the section, only sections that start and end in
+    # this packet are parsed, which is how PAT and PMT are carried in practice
+    start += 1 + packet[start]
+    if start + 3 > PACKET_SIZE:
+        return None
+    section_length = (packet[start + 1] & 0x0f) << 8 | packet[start + 2]
+    end = start + 3 + section_length - 4
+    if end > PACKET_SIZE:
+        return None
+    return start, end
+
+
+def parse_pat(probe, packet, start):
+    section = get_section(packet, start)
+    if section is None:
+        return
+    start, end = section
+    # every read stays inside the section, a short or garbled one is ignored
+    for offset in range(start + 8, end - 3, 4):
+        program_number = packet[offset] << 8 | packet[offset + 1]
+        if program_number != 0:
+            probe.pmt_pids.add((packet[offset + 2] & 0x1f) << 8 | packet[offset + 3])
+
+
+def parse_pmt(probe, packet, start):
+    section = get_section(packet, start)
+    if section is None:
+        return
+    start, end = section
+    if start + 12 > end:
+        return
+    program_info_length = (packet[start + 10] & 0x0f) << 8 | packet[start + 11]
+    offset = start + 12 + program_info_length
+    while offset + 5 <= end:
+        stream_type = packet[offset]
+        pid = (packet[offset + 1] & 0x1f) << 8 | packet[offset + 2]
+        es_info_length = (packet[offset + 3] & 0x0f) << 8 | packet[offset + 4]
+        codec = STREAM_TYPES.get(stream_type)
+        descriptor = offset + 5
+        descriptors_end = min(offset + 5 + es_info_length, end)
+        while codec is None and descriptor + 2 <= descriptors_end:
+            codec = DESCRIPTOR_CODECS.get(packet[descriptor])
+            descriptor += 2 + packet[descriptor + 1]
+        if pid not in probe.streams:
+            probe.streams[pid] = Stream(pid, stream_type, codec or f'unknown-{stream_type:#04x}')
+        offset += 5 + es_info_length
+
+
+def parse_pes(stream, packet, start):
+    if start + 14 > PACKET_SIZE or packet[start:start + 3] != b'\x00\x00\x01':
+        return
+    stream.pes += 1
+    if packet[start + 7] & 0x80:
+        stream.add_pts(parse_pts(packet, start + 9))
+
+
+def probe(path):
+    result = Probe(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    result.size = len(data)
+    view = memoryview(data)
+    continuity = {}
+
+    offset = 0
+    # resynchronise on the first sync byte, a fragment that never has one
+    # is most likely still encrypted
+    if data[:1] != bytes([SYNC_BYTE]):
+        result.sync_errors += 1
+        offset = data.find(bytes([SYNC_BYTE]))
+        if offset < 0:
+            return result
+    while offset + PACKET_SIZE <= len(data):
+        packet = view[offset:offset + PACKET_SIZE]
+        if packet[0] != SYNC_BYTE:
+            result.sync_errors += 1
+            next_offset = data.find(bytes([SYNC_BYTE]), offset + 1)
+            if next_offset < 0:
+                break
+            offset = next_offset
+            continue
+        offset += PACKET_SIZE
+        result.packets += 1
+
+        pid = (packet[1] & 0x1f) << 8 | packet[2]
+        if pid == NULL_PID:
+            continue
+        payload_unit_start = packet[1] & 0x40
+        scrambling = packet[3] >> 6
+        adaptation_field_control = packet[3] >> 4 & 0x03
+        counter = packet[3] & 0x0f
+
+        start = 4
+        discontinuity = False
+        if adaptation_field_control & 0x02:
+            adaptation_field_length = packet[4]
+            if adaptation_field_length:
+                discontinuity = bool(packet[5] & 0x80)
+            start = 5 + adaptation_field_length
+        if discontinuity:
+            result.discontinuities += 1
+
+        # the counter only moves on packets with a payload, one duplicate
+        # packet is allowed
+        if adaptation_field_control & 0x01:
+            previous = continuity.get(pid)
+            if previous is not None and not discontinuity and counter != (previous + 1) % 16 and counter != previous:
+                result.continuity_errors += 1
+            continuity[pid] = counter
+        if not adaptation_field_control & 0x01 or start >= PACKET_SIZE or not payload_unit_start:
+            continue
+
+        if scrambling:
+            result.scrambled += 1
+        elif pid == PAT_PID:
+            parse_pat(result, packet, start)
+        elif pid in result.pmt_pids:
+            parse_pmt(result, packet, start)
+        elif pid in result.streams:
+            parse_pes(result.streams[pid], packet, start)
+    return result
+
+
+def natural_key(path):
+    # segment-2 before segment-10
+    return [int(part) if part.isdigit() else part for part in DIGITS_PATTERN.split(str(path))]
+
+
+def get_manifest_fragments(path):
+    with open(path) as f:
+        playlist = MediaPlaylist(f.read())
+    fragments = []
+    for segment in playlist.segments:
+        fragment_path = path.parent.joinpath(segment.uri)
+        if not fragment_path.is_file():
+            logging.warning(f'missing fragment, skipped - {fragment_path}')
+            continue
+        fragments.append(fragment_path)
+    return fragments
+
+
+def get_fragments(path):
+    # a localised manifest whose fragments are relative to it, or a capture
+    # directory, in playlist order from its localised level manifests when
+    # there are any, otherwise by natural sort, exports are left out
+    path = pathlib.Path(path)
+    if not path.is_dir():
+        return get_manifest_fragments(path)
+    manifests = sorted(path.rglob('localised-level-*.m3u8'), key=natural_key)
+    if manifests:
+        return [fragment for manifest in manifests for fragment in get_manifest_fragments(manifest)]
+    return sorted((fragment for fragment in path.rglob('*.ts')
+                   if fragment.is_file() and not fragment.name.startswith('export-')), key=natural_key)
+
+
+def probe_all(fragments, jobs=None, chunksize=16):
+    if jobs == 1:
+        return [probe(fragment) for fragment in fragments]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(probe, fragments, chunksize=chunksize))
+
+
+def get_gap(previous, current):
+    # seconds between the end of the previous fragment and the start of this
+    # one on the main stream, about one frame when they are contiguous
+    if previous is None or current is None or previous.pid != current.pid:
+        return None
+    gap = (current.min_pts - previous.max_pts) % PTS_WRAP
+    if gap >= PTS_WRAP // 2:
+        gap -= PTS_WRAP
+    return gap / PTS_CLOCK
+
+
+def print_table(probes, root):
+    print(f'{"fragment":<48} {"codecs":<40} {"start":>12} {"duration":>9} {"gap":>8} {"cc":>4} {"disc":>4}')
+    previous = None
+    previous_path = None
+    for result in probes:
+        main_stream = result.get_main_stream()
+        name = os.path.relpath(result.path, root)
+        if previous is not None and os.path.dirname(result.path) != os.path.dirname(previous_path):
+            # gaps are only meaningful within one level
+            previous = None
+        previous_path = result.path
+        if not result.is_valid():
+            print(f'{name:<48} {"not mpeg-ts, encrypted or empty":<40}')
+            logging.warning(f'cannot probe - {result.path} - {result.sync_errors} sync errors')
+            previous = None
+            continue
+        start = f'{main_stream.min_pts / PTS_CLOCK:.3f}' if main_stream else '-'
+        duration = f'{main_stream.get_duration():.3f}' if main_stream else '-'
+        gap = get_gap(previous, main_stream)
+        gap = f'{gap:.3f}' if gap is not None else '-'
+        print(f'{name:<48} {result.get_codecs():<40} {start:>12} {duration:>9} {gap:>8} '
+              f'{result.continuity_errors:>4} {result.discontinuities:>4}')
+        if result.continuity_errors or result.scrambled:
+            logging.warning(f'{result.path} - {result.continuity_errors} continuity errors, '
+                            f'{result.scrambled} scrambled packets')
+        previous = main_stream
+
+
+def main(args):
+    fragments = get_fragments(args.input)
+    probes = probe_all(fragments, args.jobs, args.chunksize)
+    if args.json:
+        for result in probes:
+            print(json.dumps(result.to_dict()))
+        return
+    root = args.input if os.path.isdir(args.input) else os.path.dirname(args.input) or '.'
+    print_table(probes, root)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = ArgumentParser()
+    parser.description = 'Read codecs, pids, pts ranges and discontinuities from mpeg-ts fragments'
+    parser.add_argument('input',
+                        help='capture directory, or a localised level manifest, eg ./localised-level-00950400-0288p.m3u8')
+    parser.add_argument('-j', '--jobs',
+                        help='probing processes, 1 probes in this process',
+                        default=os.cpu_count(),
+                        type=int)
+    parser.add_argument('--chunksize',
+                        help='fragments handed to a process at a time',
+                        default=16,
+                        type=int)
+    parser.add_argument('--json',
+                        help='one json object per fragment instead of a table',
+                        action='store_true')
+    parser.add_argument("-d", "--debug",
+                        help="Enable debug",
+                        action="store_const",
+                        dest='loglevel',
+                        const=logging.DEBUG,
+                        default=logging.INFO)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.loglevel)
+    main(args)
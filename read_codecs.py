@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
 import sys
-import ffmpegio
 import logging
+import hls_probe
 
 logging.basicConfig(level=logging.DEBUG)
 fragment = sys.argv[1]
-stream, fragment = ffmpegio.audio.read(fragment)
-logging.debug(stream)
-logging.debug(fragment)
\ No newline at end of file
+probe = hls_probe.probe(fragment)
+for stream in probe.streams.values():
+    logging.debug(f'{stream.pid:#x} {stream.codec} pes {stream.pes} pts {stream.min_pts}-{stream.max_pts} '
+                  f'{stream.get_duration():.3f}s')
+logging.debug(f'{probe.packets} packets, {probe.continuity_errors} continuity errors, '
+              f'{probe.discontinuities} discontinuities')
@@ -1,12 +1,7 @@
 #!/bin/bash
 
+# a capture directory or a localised level manifest, every fragment is probed
+# in one pass by hls_probe.py instead of an ffprobe process per fragment
 input=$1
-directory=$(dirname $input)
-if [[ -d $input ]]; then
-    for fragment in $(find "$input" -name *.ts | sort)
-    do
-        ffprobe $fragment 2>&1 | grep -e Input -e Audio
-    done
-elif [[ -f $input ]]; then
-    grep .ts $input | xargs -I {} sh -c "ffprobe $directory/{} 2>&1 | grep -e Input -e Audio"
-fi
+[[ -z $input ]] && echo "$0 capture_directory|localised-level.m3u8" && exit
+python3 "$(dirname "$0")/hls_probe.py" "$input"
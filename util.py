@@ -2,6 +2,7 @@
 
 import re
 import shutil
+import pathlib
 import logging
 
 logging.basicConfig(level=logging.DEBUG)